@@ -4,54 +4,20 @@ import json
 import pyautogui
 import numpy as np
 import math
+import time
+from functools import partial
+from pathlib import Path
 import fluidsynth
-from pupil_labs.realtime_api.simple import discover_one_device
-from pupil_labs.real_time_screen_gaze.gaze_mapper import GazeMapper
 from pupil_labs.real_time_screen_gaze import marker_generator
 from PySide6.QtCore import *
 from PySide6.QtGui import *
 from PySide6.QtWidgets import *
+from dwell import DwellPolicy, TargetDwell, ZonedDwellDetector
+from gaze_filters import ExponentialSmoother, GazePredictor, VelocityClassifier, filterTypes
+from gaze_pipeline import GazeWorker, LatencyBreakdown, LatencyStats, SyntheticGazeWorker, syntheticRate
 
 pyautogui.FAILSAFE = False
 
-# DwellDetector Class
-class DwellDetector():
-    def __init__(self, minimumDelayInSeconds, rangeInPixels):
-        self.minimumDelay = minimumDelayInSeconds
-        self.range = rangeInPixels
-        self.points = np.empty(shape=[0, 3])
-
-        self.inDwell = False
-
-    def setDuration(self, duration):
-        self.minimumDelay = duration
-
-    def setRange(self, rangeInPixels):
-        self.range = rangeInPixels
-
-    def addPoint(self, x, y, timestamp):
-        point = np.array([x, y, timestamp])
-
-        self.points = np.append(self.points, [point], axis=0)
-        if self.points[-1,2] - self.points[0,2] < self.minimumDelay:
-            return False, False, None
-
-        minTimestamp = timestamp - self.minimumDelay - .0001
-        self.points = self.points[self.points[:,2] >= minTimestamp]
-
-        center = np.mean(self.points[:,:2], axis=0)
-        distances = np.sqrt(np.sum(self.points[:,:2] - center, axis=1)**2)
-
-        if np.max(distances) < self.range:
-            inDwell = True
-        else:
-            inDwell = False
-
-        changed = inDwell != self.inDwell
-        self.inDwell = inDwell
-
-        return changed, inDwell, center
-
 # TagWindow Class
 def createMarker(marker_id):
     marker = marker_generator.generate_marker(marker_id, flip_x=True, flip_y=True)
@@ -75,6 +41,13 @@ class TagWindow(QWidget):
     dwellRadiusChanged = Signal(int)
     dwellTimeChanged = Signal(float)
     smoothingChanged = Signal(float)
+    filterChanged = Signal(str)
+    notePlayed = Signal(float)
+    painted = Signal(float)
+
+    participantColors = [Qt.white, Qt.cyan, Qt.yellow, Qt.green]
+    progressRingWidth = 6
+    progressStep = 1/64 # smallest dwell progress change worth repainting a ring for
 
     def __init__(self):
         super().__init__()
@@ -87,8 +60,11 @@ class TagWindow(QWidget):
             self.markerIDs.append(markerID)
             self.pixmaps.append(createMarker(markerID))
 
-        self.point = (0, 0)
-        self.clicked = False
+        # One cursor per participant, each (x, y) in widget coordinates
+        self.points = [(0, 0)]
+        self.progress = [0.0]
+        # Dwell radius per cursor, None for that of the dwell radius input
+        self.radii = [None]
         self.settingsVisible = True
         self.visibleMarkerIds = []
 
@@ -114,6 +90,7 @@ class TagWindow(QWidget):
         self.dwellRadiusInput.setRange(0, 512)
         self.dwellRadiusInput.setValue(15)
         self.dwellRadiusInput.valueChanged.connect(self.dwellRadiusChanged.emit)
+        self.dwellRadiusInput.valueChanged.connect(self.onDwellRadiusChanged)
 
         self.dwellTimeInput = QDoubleSpinBox()
         self.dwellTimeInput.setRange(0, 20)
@@ -124,6 +101,12 @@ class TagWindow(QWidget):
         self.mouseEnabledInput.setChecked(True)
         self.mouseEnabledInput.toggled.connect(self.mouseEnableChanged.emit)
 
+        self.filterInput = QComboBox()
+        self.filterInput.addItems(list(filterTypes))
+        self.filterInput.setCurrentText('Exponential') #choose the gaze filter here
+        self.filterInput.currentTextChanged.connect(self.filterChanged.emit)
+        self.form.layout().addRow('Gaze filter', self.filterInput)
+
         
 
         self.instructionsLabel = QLabel('Right-click one of the tags to toggle settings view.')
@@ -271,37 +254,71 @@ class TagWindow(QWidget):
     def setStatus(self, status):
         self.statusLabel.setText(status)
 
-    def setClicked(self, clicked):
-        self.clicked = clicked
-        self.repaint()
+    def setParticipantCount(self, count):
+        self.points = [(0, 0)] * count
+        self.progress = [0.0] * count
+        self.radii = [None] * count
+        self.update()
 
-    def updatePoint(self, norm_x, norm_y):
-        tagMargin = 0.1 * self.tagSizeInput.value()
-        surfaceSize = (
-            self.width() - 2*tagMargin,
-            self.height() - 2*tagMargin,
-        )
+    def getCursorRadius(self, participant):
+        radius = self.radii[participant]
+        return self.dwellRadiusInput.value() if radius is None else radius
 
-        self.point = (
-            norm_x*surfaceSize[0] + tagMargin,
-            (surfaceSize[1] - norm_y*surfaceSize[1]) + tagMargin
-        )
+    def getCursorRect(self, participant):
+        # All a cursor and its dwell progress ring paint on
+        x, y = self.points[participant]
+        radius = int(self.getCursorRadius(participant)) + self.progressRingWidth + 2
+        return QRect(int(x) - radius, int(y) - radius, 2*radius + 1, 2*radius + 1)
 
-        self.repaint()
-        return self.mapToGlobal(QPoint(*self.point))
+    def setCursorRadius(self, radius, participant=0):
+        # The radius of the dwell that applies where the cursor is, None for
+        # that of the dwell radius input
+        if radius == self.radii[participant]:
+            return
+        self.update(self.getCursorRect(participant))
+        self.radii[participant] = radius
+        self.update(self.getCursorRect(participant))
+
+    def setProgress(self, progress, participant=0):
+        # Dwell progress from 0 to 1. Only the cursor is repainted, and only
+        # once its ring visibly changed, started or completed.
+        shown = self.progress[participant]
+        if abs(progress - shown) < self.progressStep and (progress > 0) == (shown > 0) and (progress >= 1) == (shown >= 1):
+            return
+        self.progress[participant] = progress
+        self.update(self.getCursorRect(participant))
+
+    def setPoint(self, x, y, participant=0):
+        # Widget coordinates, already mapped by PupilPointerApp. Only where the
+        # cursor was and where it is now are repainted.
+        self.update(self.getCursorRect(participant))
+        self.points[participant] = (x, y)
+        self.update(self.getCursorRect(participant))
+
+    def drawProgress(self, painter, participant, point):
+        # A ring around the cursor filling clockwise from the top, red once the dwell is complete
+        progress = self.progress[participant]
+        if progress <= 0:
+            return
+
+        radius = self.getCursorRadius(participant) + self.progressRingWidth/2 + 1
+        painter.save()
+        painter.setPen(QPen(Qt.red if progress >= 1 else Qt.black, self.progressRingWidth, Qt.SolidLine, Qt.FlatCap))
+        painter.setBrush(Qt.NoBrush)
+        painter.drawArc(QRectF(point[0] - radius, point[1] - radius, 2*radius, 2*radius), 90*16, -round(progress*360*16))
+        painter.restore()
 
     def showMarkerFeedback(self, markerIds):
+        if markerIds == self.visibleMarkerIds:
+            return
         self.visibleMarkerIds = markerIds
-        self.repaint()
+        self.update()
 
     def paintEvent(self, event):
         painter = QPainter(self)
 
         if self.settingsVisible:
-            if self.clicked:
-                painter.setBrush(Qt.white)
-            else:
-                painter.setBrush(Qt.white)
+            painter.setBrush(Qt.white)
 
             
 
@@ -389,8 +406,14 @@ class TagWindow(QWidget):
                 # Draw single dot marker
                 painter.setBrush(QBrush(Qt.white))
                 painter.drawEllipse(QPointF(x_center, y_center), marker_radius, marker_radius)
-            
-            painter.drawEllipse(QPoint(*self.point), self.dwellRadiusInput.value(), self.dwellRadiusInput.value())
+
+        # Draw a cursor for every participant
+        for participant, point in enumerate(self.points):
+            painter.setBrush(QBrush(self.participantColors[participant]))
+            painter.drawEllipse(QPoint(*point), self.getCursorRadius(participant), self.getCursorRadius(participant))
+            self.drawProgress(painter, participant, point)
+
+        self.painted.emit(time.monotonic())
 
     def mousePressEvent(self, event):
         if event.button() == Qt.LeftButton:
@@ -430,6 +453,7 @@ class TagWindow(QWidget):
         }        
         midi_note = note_map.get(note, 60)
         self.fs.noteon(0, midi_note, 127)  # Play the note with full velocity
+        self.notePlayed.emit(time.monotonic())
         QTimer.singleShot(500, lambda: self.fs.noteoff(0, midi_note))  # Stop the note after 500ms
 
     def get_string_index(self, point):
@@ -563,10 +587,53 @@ class TagWindow(QWidget):
         self.updateMask()
         self.surfaceChanged.emit()
 
+    def onDwellRadiusChanged(self, value):
+        # Cursors change size, the regions setPoint repaints no longer cover them
+        self.update()
+
     def onTagSizeChanged(self, value):
         self.repaint()
         self.surfaceChanged.emit()
 
+    def getTargets(self):
+        # Widget coordinates of the middle of every fret gap on every string
+        targets = []
+        for string_index in range(self.strings):
+            start_point = self.string_start_points[string_index]
+            end_point = self.string_end_points[string_index]
+            for fret_index in range(self.frets):
+                x = start_point.x() + (end_point.x() - start_point.x()) * ((fret_index + 0.5) / self.frets)
+                targets.append((x, start_point.y()))
+        return targets
+
+    def getTargetAt(self, x, y):
+        # Index into getTargets of the fret gap at widget coordinates (x, y), or
+        # None. Every string owns the band halfway to its neighbours, much wider
+        # than the strip get_string_index accepts for mouse clicks.
+        top = self.string_start_points[0].y()
+        string_spacing = self.string_start_points[1].y() - top
+        string_index = int(((y - top) / string_spacing + 0.5) // 1)
+        if not 0 <= string_index < self.strings:
+            return None
+
+        start_x = self.string_start_points[string_index].x()
+        end_x = self.string_end_points[string_index].x()
+        fret_index = int((x - start_x) // ((end_x - start_x) / self.frets))
+        if not 0 <= fret_index < self.frets:
+            return None
+        return string_index * self.frets + fret_index
+
+    def getDwellZones(self):
+        # (name, (left, top, right, bottom)) in widget coordinates of the screen
+        # areas that can have dwell settings of their own
+        zones = []
+        for button in (self.play_button, self.record_button, self.volume_up_button, self.volume_down_button):
+            rect = button.geometry()
+            zones.append(('controls', (rect.left(), rect.top(), rect.left() + rect.width(), rect.top() + rect.height())))
+        # The fretboard, with the buttons above it
+        zones.append(('notes', (self.top_left.x(), self.top_left.y(), self.bottom_right.x(), self.bottom_right.y())))
+        return zones
+
     def getMarkerSize(self):
         return self.tagSizeInput.value()
 
@@ -592,6 +659,24 @@ class TagWindow(QWidget):
     def getSurfaceSize(self):
         return (self.width(), self.height())
 
+    def getSurfaceTransform(self):
+        # Normalized surface gaze (origin bottom left) to widget pixels as a
+        # 2x3 affine matrix; the surface is inset from the window by a tenth
+        # of the tag size on every side
+        tagMargin = 0.1 * self.getMarkerSize()
+        surfaceWidth = self.width() - 2*tagMargin
+        surfaceHeight = self.height() - 2*tagMargin
+        return np.array([
+            [surfaceWidth, 0, tagMargin],
+            [0, -surfaceHeight, surfaceHeight + tagMargin],
+        ])
+
+    def getSurfaceTargets(self):
+        # getTargets in normalized surface coordinates, for synthetic gaze
+        transform = self.getSurfaceTransform()
+        targets = np.array(self.getTargets(), dtype=np.float64)
+        return ((targets - transform[:, 2]) / np.diag(transform[:, :2])).tolist()
+
     def updateMask(self):
         if self.settingsVisible:
             mask = QRegion(0, 0, self.width(), self.height())
@@ -621,6 +706,27 @@ class TagWindow(QWidget):
         elif cornerIdx == 3:
             return QRect(0, self.height()-tagSizePadded, tagSizePadded, tagSizePadded)
 
+class Participant():
+    # One pair of glasses and everything that follows from it: a gaze worker
+    # thread, smoothing, dwell detection, a cursor and latency counters
+    def __init__(self, index, gazeWorker, dwellMode):
+        self.index = index
+        self.gazeWorker = gazeWorker
+        self.dwellDetector = ZonedDwellDetector(.75, 75, mode=dwellMode)
+        self.targetDwell = TargetDwell(.75)
+        self.smoother = ExponentialSmoother(0.8)
+        self.predictor = GazePredictor()
+        self.classifier = VelocityClassifier()
+        self.markerIds = []
+        self.deviceStatus = 'Looking for a device...'
+        self.pollLatency = LatencyStats()
+        self.arrivalDelay = LatencyStats()
+        self.samples = 0
+        self.gatedSamples = 0
+        self.latency = LatencyBreakdown()
+        self.paintRequestedAt = None
+        self.shownCapturedAt = None
+
 # PupilPointerApp Class
 class PupilPointerApp(QApplication):
     def __init__(self):
@@ -631,111 +737,332 @@ class PupilPointerApp(QApplication):
 
         self.tagWindow = TagWindow()
 
-        self.device = None
-        self.dwellDetector = DwellDetector(.75, 75)
-        self.smoothing = 0.8
+        # Ensemble sessions: every participant wears their own glasses and
+        # gets their own worker thread, so participants scale across cores
+        self.participantCount = 1 # set to 2 to 4 for ensemble sessions
+        self.dwellMode = 'dispersion' # set to 'legacy' for the original |dx + dy| dwell spread
+        self.targetDwell = False # set to True to dwell on grid targets, each with its own accumulated time
+        self.classifyGaze = True # set to False to run dwell detection on saccades too
+        # Dwell seconds and radius per TagWindow.getDwellZones zone, all served
+        # from one sample window; elsewhere the dwell time and radius inputs apply
+        self.dwellPolicies = {} # set to e.g. {'controls': (1.5, 75), 'notes': (0.5, 50)} for per-zone dwell
+        self.dwellZonesKey = None
+        self.participants = [
+            Participant(index, self.createGazeWorker(index), self.dwellMode)
+            for index in range(self.participantCount)
+        ]
+        self.tagWindow.setParticipantCount(self.participantCount)
 
-        self.tagWindow.surfaceChanged.connect(self.onSurfaceChanged)
+        for participant in self.participants:
+            participant.gazeWorker.statusChanged.connect(partial(self.setDeviceStatus, participant))
+            self.tagWindow.dwellTimeChanged.connect(participant.dwellDetector.setDuration)
+            self.tagWindow.dwellTimeChanged.connect(participant.targetDwell.setDuration)
+            self.tagWindow.dwellRadiusChanged.connect(participant.dwellDetector.setRange)
 
-        self.tagWindow.dwellTimeChanged.connect(self.dwellDetector.setDuration)
-        self.tagWindow.dwellRadiusChanged.connect(self.dwellDetector.setRange)
+        self.tagWindow.surfaceChanged.connect(self.onSurfaceChanged)
         self.tagWindow.mouseEnableChanged.connect(self.setMouseEnabled)
         self.tagWindow.smoothingChanged.connect(self.setSmoothing)
+        self.tagWindow.filterChanged.connect(self.setFilter)
+        self.tagWindow.notePlayed.connect(self.onNotePlayed)
+        self.tagWindow.painted.connect(self.onPainted)
+        self.pendingDwell = None
 
-        self.pollTimer = QTimer()
-        self.pollTimer.setInterval(1000/30)
-        self.pollTimer.timeout.connect(self.poll)
+        # Draw the cursor where the gaze will be once it is on screen
+        self.predictGaze = False # set to True to extrapolate the cursor over the measured latency (off during saccades)
 
-        self.surface = None
-        self.firstPoll = True
+        # Handle gaze as soon as the worker has some, rather than on a timer
+        self.eventDriven = True # set to False to poll the worker at a fixed 30 Hz instead
 
-        self.mousePosition = None
-        self.gazeMapper = None
+        self.pollTimer = QTimer()
+        self.pollTimer.setInterval(1000/30)
+        self.pollTimer.timeout.connect(self.pollAll)
+
+        self.statsTimer = QTimer()
+        self.statsTimer.setInterval(1000)
+        self.statsTimer.timeout.connect(self.showStats)
+
+        # Resizing and tag size edits arrive in bursts; apply them once settled
+        self.surfaceTimer = QTimer()
+        self.surfaceTimer.setSingleShot(True)
+        self.surfaceTimer.setInterval(250)
+        self.surfaceTimer.timeout.connect(self.updateSurface)
+        self.surfaceDefinitions = {}
+        self.surfaceKey = None
+
+        self.transformKey = None
+        self.surfaceTransform = None
+
+    def createGazeWorker(self, index):
+        # The device and the GazeMapper are owned by the worker thread.
+        # PUPIL_SYNTHETIC=<rate in Hz> replaces them with generated gaze.
+        if syntheticRate():
+            return SyntheticGazeWorker(syntheticRate(), seed=index)
+
+        # Every participant records into a participant-<n> subdirectory of it
+        recordTo = None # set to a directory to record the session (replay it with PUPIL_REPLAY=<directory>/participant-1)
+        return GazeWorker(
+            markerProcesses=0, # set to 2 or more to detect markers in worker processes
+            detectionInterval=1, # set above 1 to reuse the surface homography between marker detections
+            fullRate=False, # set to True to use every gaze sample instead of one per scene frame
+            adaptiveDetection=False, # set to True to find markers on downscaled grayscale frames
+            recordTo=None if recordTo is None else Path(recordTo) / f'participant-{index + 1}',
+        )
 
     def onSurfaceChanged(self):
-        self.updateSurface()
+        self.surfaceTimer.start()
 
     def start(self):
-        self.device = discover_one_device(max_search_duration_seconds=0.25)
-
-        if self.device is None:
-            QTimer.singleShot(1000, self.start)
+        self.updateSurface()
+        for participant in self.participants:
+            if self.eventDriven:
+                participant.gazeWorker.gazeAvailable.connect(partial(self.poll, participant))
+            participant.gazeWorker.start()
+
+        if not self.eventDriven:
+            self.pollTimer.start()
+        self.statsTimer.start()
+
+    def stop(self):
+        for participant in self.participants:
+            participant.gazeWorker.stop()
+
+    def updateDwellZones(self, origin):
+        # The detectors are fed global coordinates, so the zones follow the
+        # window wherever it moves; origin is its top left on screen
+        key = (origin.x(), origin.y(), self.tagWindow.width(), self.tagWindow.height())
+        if key == self.dwellZonesKey:
             return
 
-        calibration = self.device.get_calibration()
-        self.gazeMapper = GazeMapper(calibration)
-
-        self.tagWindow.setStatus(f'Connected to {self.device}. One moment...')
-
-        self.updateSurface()
-        self.pollTimer.start()
-        self.firstPoll = True
+        self.dwellZonesKey = key
+        for participant in self.participants:
+            participant.dwellDetector.setPolicies([
+                DwellPolicy(name, *self.dwellPolicies[name], zone=(
+                    left + origin.x(), top + origin.y(), right + origin.x(), bottom + origin.y()
+                ))
+                for name, (left, top, right, bottom) in self.tagWindow.getDwellZones()
+                if name in self.dwellPolicies
+            ])
 
     def updateSurface(self):
-        if self.gazeMapper is None:
+        surfaceSize = self.tagWindow.getSurfaceSize()
+        key = (surfaceSize, self.tagWindow.getMarkerSize())
+        if key == self.surfaceKey:
             return
 
-        self.gazeMapper.clear_surfaces()
-        self.surface = self.gazeMapper.add_surface(
-            self.tagWindow.getMarkerVerts(),
-            self.tagWindow.getSurfaceSize()
-        )
+        if key not in self.surfaceDefinitions:
+            self.surfaceDefinitions[key] = (self.tagWindow.getMarkerVerts(), surfaceSize)
+
+        self.surfaceKey = key
+        for participant in self.participants:
+            participant.gazeWorker.setSurface(*self.surfaceDefinitions[key], key)
+            if isinstance(participant.gazeWorker, SyntheticGazeWorker):
+                participant.gazeWorker.setTargets(self.tagWindow.getSurfaceTargets())
+
+    def setDeviceStatus(self, participant, status):
+        participant.deviceStatus = status
+        self.tagWindow.setStatus(self.getDeviceStatus())
+
+    def getDeviceStatus(self):
+        if len(self.participants) == 1:
+            return self.participants[0].deviceStatus
+
+        return '\n'.join(f'Participant {participant.index + 1}: {participant.deviceStatus}' for participant in self.participants)
+
+    def showStats(self):
+        lines = []
+        for participant in self.participants:
+            if not participant.pollLatency.samples:
+                continue
+
+            gazeWorker = participant.gazeWorker
+            output = gazeWorker.output
+            stats = (
+                f'Arrival to handling ({"event" if self.eventDriven else "30 Hz timer"}): {participant.arrivalDelay.summary()}\n'
+                f'Worker to GUI: {participant.pollLatency.summary()}, dropped {output.dropped} of {output.written}\n'
+                f'Stale scene frames dropped: {gazeWorker.droppedFrames()} of {gazeWorker.framesReceived}'
+            )
+            if gazeWorker.surfaceCache is not None:
+                stats += f'\nSurface cache: {gazeWorker.surfaceCache.summary()}'
+            stats += (
+                f'\nDwell gate closed for {participant.gatedSamples} of {participant.samples} samples, '
+                f'dwell paused {participant.dwellDetector.pauses} times'
+            )
+            if self.classifyGaze:
+                stats += f'\nGaze: {participant.classifier.summary()}'
+            stats += f'\n{participant.latency.summary()}'
+
+            if len(self.participants) > 1:
+                stats = f'Participant {participant.index + 1}\n{stats}'
+            lines.append(stats)
+
+        if lines:
+            self.tagWindow.setStatus(self.getDeviceStatus() + '\n' + '\n'.join(lines))
 
     def setMouseEnabled(self, enabled):
         self.mouseEnabled = enabled
 
     def setSmoothing(self, value):
-        self.smoothing = value
-
-    def poll(self):
-        frameAndGaze = self.device.receive_matched_scene_video_frame_and_gaze(timeout_seconds=1/15)
-
-        if frameAndGaze is None:
+        for participant in self.participants:
+            participant.smoother.setSmoothing(value)
+
+    def setFilter(self, name):
+        # Filters start over from the next sample, with the current smoothing
+        smoothing = self.tagWindow.smoothingInput.value()
+        for participant in self.participants:
+            participant.smoother = filterTypes[name](smoothing)
+
+    def getSurfaceTransform(self):
+        # TagWindow.getSurfaceTransform, rebuilt only on size changes
+        key = (self.tagWindow.width(), self.tagWindow.height(), self.tagWindow.getMarkerSize())
+        if key != self.transformKey:
+            self.surfaceTransform = self.tagWindow.getSurfaceTransform()
+            self.transformKey = key
+
+        return self.surfaceTransform
+
+    def showMarkerFeedback(self, participant, markerIds):
+        # A marker only counts as visible while every participant sees it
+        participant.markerIds = markerIds
+        visible = set(self.participants[0].markerIds)
+        for other in self.participants[1:]:
+            visible &= set(other.markerIds)
+        self.tagWindow.showMarkerFeedback(sorted(visible))
+
+    def pollAll(self):
+        for participant in self.participants:
+            self.poll(participant)
+
+    def poll(self, participant):
+        mappedGaze = participant.gazeWorker.output.take()
+        if mappedGaze is None:
             return
 
-        else:
-            self.tagWindow.setStatus(f'Streaming data from {self.device}')
-            self.firstPoll = False
-
-        frame, gaze = frameAndGaze
-        result = self.gazeMapper.process_frame(frame, gaze)
-
-        markerIds = [int(marker.uid.split(':')[-1]) for marker in result.markers]
-        self.tagWindow.showMarkerFeedback(markerIds)
+        handledAt = time.monotonic()
+        participant.pollLatency.add(handledAt - mappedGaze.publishedAt)
+        participant.arrivalDelay.add(handledAt - mappedGaze.receivedAt)
+        latency = participant.latency
+        latency.add('network', mappedGaze.receivedAt - (mappedGaze.timestamp - mappedGaze.clockOffset))
+        latency.add('mapping', mappedGaze.publishedAt - mappedGaze.receivedAt)
+        latency.add('handover', handledAt - mappedGaze.publishedAt)
+        self.showMarkerFeedback(participant, mappedGaze.markerIds)
+        if not mappedGaze.points:
+            return
 
-        if self.surface.uid in result.mapped_gaze:
-            for surface_gaze in result.mapped_gaze[self.surface.uid]:
-                if self.mousePosition is None:
-                    self.mousePosition = [surface_gaze.x, surface_gaze.y]
+        # Samples taken during blinks and dropouts never reach smoothing or
+        # dwell detection; the gap they leave pauses the dwell timer
+        samples = np.array(mappedGaze.points)
+        eyeOpen = samples[:, 3] > 0
+        participant.samples += len(samples)
+        participant.gatedSamples += len(samples) - np.count_nonzero(eyeOpen)
+        samples = samples[eyeOpen]
+        if not len(samples):
+            return
 
-                else:
-                    self.mousePosition[0] = self.mousePosition[0] * self.smoothing + surface_gaze.x * (1.0 - self.smoothing)
-                    self.mousePosition[1] = self.mousePosition[1] * self.smoothing + surface_gaze.y * (1.0 - self.smoothing)
+        # The whole batch is smoothed and mapped at once; only the final
+        # position and any dwell transitions reach the UI
+        transform = self.getSurfaceTransform()
+        smoothed = participant.smoother.filterBatch(samples[:, :2], samples[:, 2])
+        # Fixation, saccade or pursuit per sample; participant.classifier.label
+        # holds the newest for anything else that wants it
+        labels = None
+        if self.classifyGaze:
+            labels = participant.classifier.classify(samples[:, :2], smoothed, samples[:, 2])
+        widgetPoints = smoothed @ transform[:, :2].T + transform[:, 2]
+        origin = self.tagWindow.mapToGlobal(QPoint(0, 0))
+        globalPoints = widgetPoints + (origin.x(), origin.y())
+
+        # Only the cursor is predicted; dwell detection keeps the measured gaze
+        cursor = widgetPoints[-1]
+        if self.predictGaze:
+            predicted = participant.predictor.predict(
+                samples[:, :2], smoothed, samples[:, 2],
+                latency.stats['paint'].mean(), participant.smoother.lag(),
+            )
+            cursor = predicted @ transform[:, :2].T + transform[:, 2]
 
-                mousePoint = self.tagWindow.updatePoint(*self.mousePosition)
+        if self.targetDwell:
+            self.dwellOnTargets(participant, widgetPoints, samples[:, 2], labels, mappedGaze.clockOffset, origin)
+            progress = participant.targetDwell.progress
+            radius = None
+        else:
+            self.updateDwellZones(origin)
+            self.dwellOnPoints(participant, globalPoints, samples[:, 2], labels, mappedGaze.clockOffset)
+            progress = participant.dwellDetector.progress
+            radius = participant.dwellDetector.policy.range
+        latency.add('dwell', time.monotonic() - handledAt)
+
+        if participant.paintRequestedAt is None:
+            participant.paintRequestedAt = time.monotonic()
+        participant.shownCapturedAt = samples[-1, 2] - mappedGaze.clockOffset
+        self.tagWindow.setPoint(*cursor, participant.index)
+        self.tagWindow.setCursorRadius(radius, participant.index)
+        self.tagWindow.setProgress(progress, participant.index)
+
+        # There is only one system cursor; the first participant steers it
+        if self.mouseEnabled and participant.index == 0:
+            QCursor().setPos(int(cursor[0] + origin.x()), int(cursor[1] + origin.y()))
+
+    def dwellOnPoints(self, participant, globalPoints, timestamps, labels, clockOffset):
+        # A saccade ends any dwell and its samples could never start one, so
+        # they only reset the detector
+        for index, ((x, y), timestamp) in enumerate(zip(globalPoints, timestamps)):
+            if labels is not None and labels[index] == 'saccade':
+                participant.dwellDetector.reset()
+                continue
+            changed, dwell, dwellPosition = participant.dwellDetector.addPoint(x, y, timestamp)
+            if changed and dwell:
+                # Device time of the activating sample, aligned to the host clock
+                self.pendingDwell = (participant, time.monotonic(), timestamp - clockOffset)
+                if self.mouseEnabled:
+                    pyautogui.click(x=dwellPosition[0], y=dwellPosition[1])
+
+    def dwellOnTargets(self, participant, widgetPoints, timestamps, labels, clockOffset, origin):
+        # Every sample is hit-tested against the grid; a target that fires is
+        # clicked in its center, wherever in it the gaze happened to be.
+        # Saccades pass over targets without dwelling on any of them.
+        for index, ((x, y), timestamp) in enumerate(zip(widgetPoints.tolist(), timestamps)):
+            target = None
+            if labels is None or labels[index] != 'saccade':
+                target = self.tagWindow.getTargetAt(x, y)
+            target = participant.targetDwell.addPoint(target, timestamp)
+            if target is not None:
+                self.pendingDwell = (participant, time.monotonic(), timestamp - clockOffset)
+                if self.mouseEnabled:
+                    targetX, targetY = self.tagWindow.getTargets()[target]
+                    pyautogui.click(x=targetX + origin.x(), y=targetY + origin.y())
 
-                changed, dwell, dwellPosition = self.dwellDetector.addPoint(mousePoint.x(), mousePoint.y(), gaze.timestamp_unix_seconds)
-                if changed and dwell:
-                    self.tagWindow.setClicked(True)
-                    if self.mouseEnabled:
-                        pyautogui.click(x=dwellPosition[0], y=dwellPosition[1])
-                else:
-                    self.tagWindow.setClicked(False)
+    def onNotePlayed(self, playedAt):
+        # Attribute a note to the dwell activation that clicked it
+        if self.pendingDwell is None:
+            return
 
-                if self.mouseEnabled:
-                    QCursor().setPos(mousePoint)
+        participant, dwellAt, capturedAt = self.pendingDwell
+        self.pendingDwell = None
+        if playedAt - dwellAt > 1.0:
+            return # a click of the real mouse, not a dwell
+        participant.latency.add('audio', playedAt - dwellAt)
+        participant.latency.add('note-on', playedAt - capturedAt)
+
+    def onPainted(self, paintedAt):
+        for participant in self.participants:
+            if participant.paintRequestedAt is None:
+                continue
+            participant.latency.add('display', paintedAt - participant.paintRequestedAt)
+            participant.latency.add('paint', paintedAt - participant.shownCapturedAt)
+            participant.paintRequestedAt = None
 
     def exec(self):
         self.tagWindow.setStatus('Looking for a device...')
         self.tagWindow.showFullScreen()
         QTimer.singleShot(1000, self.start)
         super().exec()
-        if self.device is not None:
-            self.device.close()
+        self.stop()
 
 def run():
     app = PupilPointerApp()
     app.exec()
 
 # Execute the program
-run()
+# (guarded so marker worker processes can import this file)
+if __name__ == '__main__':
+    run()
@@ -4,7 +4,7 @@ import pyautogui
 import numpy as np
 import math
 import fluidsynth  # Add FluidSynth
-from pupil_labs.realtime_api.simple import discover_one_device
+from gaze_recording import discover_one_device
 from pupil_labs.real_time_screen_gaze.gaze_mapper import GazeMapper
 from pupil_labs.real_time_screen_gaze import marker_generator
 from PySide6.QtCore import *
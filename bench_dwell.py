@@ -0,0 +1,126 @@
+import sys
+import time
+
+import numpy as np
+
+from dwell import DwellDetector, detectDwells
+from gaze_synthetic import SyntheticGaze
+
+# Cost per sample of DwellDetector.addPoint against the implementation it
+# replaced (np.append and a full recompute per sample), on synthetic gaze in
+# screen pixels at 30, 200 and 1000 Hz. The legacy mode must report the same
+# dwells as the old implementation; the dispersion mode is checked against a
+# direct computation of the window's width and height. detectDwells, the
+# offline version, must find exactly the dwells addPoint reports. progress
+# must stay below 1 outside of dwells, also right after a reset, which the
+# interfaces do on every saccade.
+#
+# Usage: python bench_dwell.py [seconds of gaze per rate]
+
+
+class LegacyDwellDetector():
+    def __init__(self, minimumDelayInSeconds, rangeInPixels):
+        self.minimumDelay = minimumDelayInSeconds
+        self.range = rangeInPixels
+        self.points = np.empty(shape=[0, 3])
+
+        self.inDwell = False
+
+    def addPoint(self, x, y, timestamp):
+        point = np.array([x, y, timestamp])
+
+        self.points = np.append(self.points, [point], axis=0)
+        if self.points[-1,2] - self.points[0,2] < self.minimumDelay:
+            return False, False, None
+
+        minTimestamp = timestamp - self.minimumDelay - .0001
+        self.points = self.points[self.points[:,2] >= minTimestamp]
+
+        center = np.mean(self.points[:,:2], axis=0)
+        distances = np.sqrt(np.sum(self.points[:,:2] - center, axis=1)**2)
+
+        if np.max(distances) < self.range:
+            inDwell = True
+        else:
+            inDwell = False
+
+        changed = inDwell != self.inDwell
+        self.inDwell = inDwell
+
+        return changed, inDwell, center
+
+
+class DirectDispersionDetector(LegacyDwellDetector):
+    dispersionInDwell = False
+
+    def addPoint(self, x, y, timestamp):
+        changed, inDwell, center = super().addPoint(x, y, timestamp)
+        if center is None:
+            return changed, inDwell, center
+
+        extent = np.ptp(self.points[:,:2], axis=0)
+        inDwell = max(extent[0], extent[1]) < 2*self.range
+        changed = inDwell != self.dispersionInDwell
+        self.dispersionInDwell = inDwell
+        return changed, inDwell, center
+
+
+def gazeSamples(rate, seconds):
+    # Blinks would pause the new detector only, so there are none here
+    targets = [(x, y) for x in (0.2, 0.5, 0.8) for y in (0.3, 0.7)]
+    gaze = SyntheticGaze(rate, targets, jitter=0.005, blinkProbability=0.0, seed=1)
+    gaze.start(0.0)
+    samples, _ = gaze.generate(seconds)
+    return [(x*1920, y*1080, t) for x, y, t in samples.tolist()]
+
+
+def measure(detector, samples):
+    states = []
+    start = time.perf_counter()
+    for x, y, timestamp in samples:
+        changed, inDwell, _ = detector.addPoint(x, y, timestamp)
+        states.append((changed, inDwell))
+    return (time.perf_counter() - start) / len(samples), states
+
+
+def progressErrors(detector, samples, resetInterval=1.3):
+    errors = 0
+    nextReset = samples[0][2] + resetInterval
+    for x, y, timestamp in samples:
+        if timestamp >= nextReset:
+            detector.reset()
+            nextReset += resetInterval
+        _, inDwell, _ = detector.addPoint(x, y, timestamp)
+        if not 0 <= detector.progress <= 1 or (detector.progress >= 1 and not inDwell):
+            errors += 1
+    return errors
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 20.0
+
+    for rate in (30, 200, 1000):
+        samples = gazeSamples(rate, seconds)
+        for mode, Reference in (('legacy', LegacyDwellDetector), ('dispersion', DirectDispersionDetector)):
+            referenceCost, referenceStates = measure(Reference(.75, 75), samples)
+            cost, states = measure(DwellDetector(.75, 75, mode=mode), samples)
+            dwells = sum(changed and inDwell for changed, inDwell in states)
+            same = 'same' if states == referenceStates else 'DIFFERENT'
+
+            start = time.perf_counter()
+            events = detectDwells(np.array(samples), .75, 75, mode=mode)
+            batchCost = (time.perf_counter() - start) / len(samples)
+            changes = [index for index, (changed, _) in enumerate(states) if changed]
+            batchSame = 'same' if events.indices.tolist() == changes else 'DIFFERENT'
+            errors = progressErrors(DwellDetector(.75, 75, mode=mode), samples)
+
+            print(
+                f'{rate:4d} Hz {mode:10s}: {cost*1e6:6.2f} us per sample, recomputed {referenceCost*1e6:7.2f} us '
+                f'({referenceCost/cost:.0f}x), {dwells} dwells, {same} results; '
+                f'batch {batchCost*1e6:5.2f} us per sample, {batchSame} results; '
+                f'{errors} progress errors'
+            )
+
+
+if __name__ == '__main__':
+    main()
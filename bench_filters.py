@@ -0,0 +1,63 @@
+import sys
+import time
+
+import numpy as np
+
+from bench_prediction import recordedSession, score, syntheticSession
+from gaze_filters import filterTypes
+
+# Compares the gaze filters PupilPointerApp can use. Gaze is filtered in
+# batches of 1/60 s, the way PupilPointerApp.poll gets it, and the newest
+# filtered position of every batch is the cursor. Reported per filter and
+# smoothing setting, lag and jitter in normalized surface units as in
+# bench_prediction, but for the cursor as soon as the batch is filtered:
+#   cost    time per sample spent in filterBatch
+#   lag     mean distance between the cursor and where the eye is, outside
+#           of saccades
+#   jitter  RMS cursor movement between batches during settled fixations
+#
+# Without arguments synthetic gaze is used; recordings made with
+# GazeWorker(recordTo=...) can be given instead.
+#
+# Usage: python bench_filters.py [recording ...]
+
+batchInterval = 1/60
+
+
+def simulate(samples, gazeFilter):
+    batches = np.floor((samples[:, 2] - samples[0, 2]) / batchInterval)
+    ends = np.flatnonzero(np.diff(batches)) + 1
+
+    cursor = []
+    elapsed = 0.0
+    for batch in np.split(samples, ends):
+        points = batch[:, :2]
+        timestamps = batch[:, 2]
+        start = time.perf_counter()
+        filtered = gazeFilter.filterBatch(points, timestamps)
+        elapsed += time.perf_counter() - start
+        cursor.append((*filtered[-1], timestamps[-1]))
+
+    return np.array(cursor), elapsed / len(samples)
+
+
+def main():
+    if len(sys.argv) > 1:
+        sessions = [(path, recordedSession(path)) for path in sys.argv[1:]]
+    else:
+        sessions = [(f'synthetic {rate} Hz', syntheticSession(rate)) for rate in (30, 200, 1000)]
+
+    for name, (samples, truth, labels) in sessions:
+        print(name)
+        for smoothing in (0.5, 0.8, 0.9):
+            for filterName, Filter in filterTypes.items():
+                cursor, cost = simulate(samples, Filter(smoothing))
+                lag, jitter = score(cursor, truth, labels)
+                print(
+                    f'  smoothing {smoothing} {filterName:12s}: {cost*1e6:5.2f} us per sample, '
+                    f'lag {lag:.4f}, jitter {jitter:.5f}'
+                )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,120 @@
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+from gaze_filters import ExponentialSmoother, GazePredictor, centeredAverage
+from gaze_synthetic import SyntheticGaze
+
+# Compares the cursor with and without GazePredictor. Gaze is fed through
+# the smoothing in batches the way PupilPointerApp.poll gets it, and every
+# cursor position is taken to appear latency seconds after its newest sample.
+# Reported per run, in normalized surface units:
+#   lag     mean distance between the cursor and where the eye actually is
+#           when the cursor appears, outside of saccades
+#   jitter  RMS cursor movement between batches during settled fixations
+#
+# Without arguments synthetic gaze is used, whose noise-free path is the
+# ground truth. Recordings made with GazeWorker(recordTo=...) can be given
+# instead; their raw gaze, averaged over 50 ms around each sample, then
+# stands in for the truth.
+#
+# Usage: python bench_prediction.py [recording ...]
+
+latency = 0.05
+batchInterval = 1/60
+
+
+def syntheticSession(rate, seconds=60.0):
+    targets = [(x, y) for x in (0.2, 0.5, 0.8) for y in (0.25, 0.75)]
+    noisy = SyntheticGaze(rate, targets, jitter=0.003, seed=1)
+    exact = SyntheticGaze(rate, targets, jitter=0.0, seed=1)
+    noisy.start(0.0)
+    exact.start(0.0)
+    samples, labels = noisy.generate(seconds)
+    truth, _ = exact.generate(seconds)
+    return samples, truth, labels
+
+
+def recordedSession(path):
+    rows = []
+    with open(Path(path) / 'events.jsonl') as events:
+        for line in events:
+            event = json.loads(line)
+            if event['kind'] == 'frame':
+                continue
+            height, width = event.get('frameShape', (1200, 1600))[:2]
+            gaze = event['gaze']
+            rows.append((gaze['x']/width, 1.0 - gaze['y']/height, gaze['timestamp_unix_seconds']))
+
+    samples = np.array(rows)
+    samples = samples[np.argsort(samples[:, 2])]
+
+    # Centered 50 ms average as the reference, labelled by its speed
+    timestamps = samples[:, 2]
+    truth = np.column_stack([centeredAverage(samples, 0.05), timestamps])
+
+    speeds = np.hypot(*np.gradient(truth[:, :2], timestamps, axis=0).T)
+    labels = np.where(speeds < 0.3, 'fixation', np.where(speeds > 1.5, 'saccade', 'pursuit'))
+    return samples, truth, labels
+
+
+def simulate(samples, smoothing, predict):
+    smoother = ExponentialSmoother(smoothing)
+    predictor = GazePredictor()
+    batches = np.floor((samples[:, 2] - samples[0, 2]) / batchInterval)
+    ends = np.flatnonzero(np.diff(batches)) + 1
+
+    cursor = []
+    for batch in np.split(samples, ends):
+        smoothed = smoother.filterBatch(batch[:, :2])
+        if predict:
+            position = predictor.predict(batch[:, :2], smoothed, batch[:, 2], latency, smoother.lag())
+        else:
+            position = smoothed[-1]
+        cursor.append((*position, batch[-1, 2] + latency))
+
+    return np.array(cursor)
+
+
+def score(cursor, truth, labels):
+    shownAt = cursor[:, 2]
+    indices = np.clip(np.searchsorted(truth[:, 2], shownAt), 0, len(truth) - 1)
+    shownLabels = labels[indices]
+    x = np.interp(shownAt, truth[:, 2], truth[:, 0])
+    y = np.interp(shownAt, truth[:, 2], truth[:, 1])
+
+    moving = shownLabels != 'saccade'
+    lag = np.mean(np.hypot(cursor[moving, 0] - x[moving], cursor[moving, 1] - y[moving]))
+
+    # Fixations that started at least settle seconds before, so the cursor is
+    # no longer catching up with the preceding saccade
+    settle = 0.6
+    earlierX = np.interp(shownAt - settle, truth[:, 2], truth[:, 0])
+    earlierY = np.interp(shownAt - settle, truth[:, 2], truth[:, 1])
+    earlierLabels = labels[np.clip(np.searchsorted(truth[:, 2], shownAt - settle), 0, len(truth) - 1)]
+    still = (shownLabels == 'fixation') & (earlierLabels == 'fixation') & (np.hypot(x - earlierX, y - earlierY) < 0.01)
+    fixating = still[1:] & still[:-1]
+    steps = np.hypot(*np.diff(cursor[:, :2], axis=0).T)[fixating]
+    jitter = np.sqrt(np.mean(steps**2))
+    return lag, jitter
+
+
+def main():
+    if len(sys.argv) > 1:
+        sessions = [(path, recordedSession(path)) for path in sys.argv[1:]]
+    else:
+        sessions = [(f'synthetic {rate} Hz', syntheticSession(rate)) for rate in (30, 200)]
+
+    for name, (samples, truth, labels) in sessions:
+        for smoothing in (0.5, 0.8, 0.9):
+            results = []
+            for predict in (False, True):
+                lag, jitter = score(simulate(samples, smoothing, predict), truth, labels)
+                results.append(f'{"predicted" if predict else "smoothed"} lag {lag:.4f} jitter {jitter:.5f}')
+            print(f'{name}, smoothing {smoothing}: ' + ' | '.join(results))
+
+
+if __name__ == '__main__':
+    main()
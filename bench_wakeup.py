@@ -0,0 +1,76 @@
+import sys
+import time
+
+from PySide6.QtCore import QCoreApplication, QThread, QTimer, Signal
+
+from gaze_pipeline import LatencyStats, LatestValue
+
+# Compares the two ways the GUI thread can pick up gaze from the worker: a
+# fixed 30 Hz poll timer and a queued wake-up signal. A producer thread stands
+# in for the device and publishes at the given rate; the delay from publish to
+# handling on the GUI thread is reported as mean and p99.
+#
+# Usage: python bench_wakeup.py [seconds per run]
+
+
+class Producer(QThread):
+    gazeAvailable = Signal()
+
+    def __init__(self, rate, output):
+        super().__init__()
+        self.rate = rate
+        self.output = output
+        self.running = True
+
+    def run(self):
+        interval = 1.0/self.rate
+        nextTime = time.monotonic()
+        while self.running:
+            nextTime += interval
+            time.sleep(max(nextTime - time.monotonic(), 0))
+            if self.output.put(time.monotonic()):
+                self.gazeAvailable.emit()
+
+
+def measure(app, rate, eventDriven, seconds):
+    output = LatestValue()
+    delay = LatencyStats(size=100000)
+
+    def handle():
+        arrivedAt = output.take()
+        if arrivedAt is not None:
+            delay.add(time.monotonic() - arrivedAt)
+
+    producer = Producer(rate, output)
+    timer = QTimer()
+    if eventDriven:
+        producer.gazeAvailable.connect(handle)
+    else:
+        timer.setInterval(1000/30)
+        timer.timeout.connect(handle)
+        timer.start()
+
+    producer.start()
+    QTimer.singleShot(int(seconds*1000), app.quit)
+    app.exec()
+
+    producer.running = False
+    producer.wait()
+    timer.stop()
+
+    return delay, output.dropped, output.written
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 3.0
+    app = QCoreApplication(sys.argv)
+
+    for rate in (30, 200):
+        for eventDriven in (False, True):
+            delay, dropped, written = measure(app, rate, eventDriven, seconds)
+            mode = 'event' if eventDriven else '30 Hz timer'
+            print(f'{rate:4d} Hz {mode:12s} {delay.summary()}, dropped {dropped} of {written}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,544 @@
+from bisect import bisect_left
+from collections import deque, namedtuple
+
+import numpy as np
+
+
+class DwellDetector():
+    # Reports whether the gaze of the last minimumDelay seconds stayed in one
+    # place. addPoint returns (changed, inDwell, center). Two measures of
+    # staying in one place are available:
+    #   'dispersion'  I-DT: the window's width and height are both below
+    #                 twice range, so the gaze stays within the square around
+    #                 the dwell circle of radius range that the cursor shows
+    #   'legacy'      what the detector always did: every |(x - cx) + (y - cy)|
+    #                 is below range, with (cx, cy) the centroid
+    #
+    # The samples of the current window live in a ring buffer, the centroid
+    # comes from running sums and the extremes from monotonic deques, so a
+    # sample costs amortized O(1). The buffer only grows (doubling) until it
+    # holds a whole window. The sums are kept as totals since the last restart
+    # minus the total before the window's oldest sample, which is how
+    # detectDwells computes them too, so both give identical results.
+    #
+    # progress says how far into a dwell the gaze is, from 0 to 1: how long
+    # it has stayed in range, over the dwell duration. It is 1 during a dwell.
+    modes = ('dispersion', 'legacy')
+
+    def __init__(self, minimumDelayInSeconds, rangeInPixels, mode='dispersion', maxGap=0.1, maxPause=1.0, capacity=64):
+        if mode not in self.modes:
+            raise ValueError(f'Unknown dwell mode {mode!r}, expected one of {self.modes}')
+
+        self.minimumDelay = minimumDelayInSeconds
+        self.range = rangeInPixels
+        self.mode = mode
+
+        self.capacity = capacity
+        self.xs = [0.0] * capacity
+        self.ys = [0.0] * capacity
+        self.sums = [0.0] * capacity
+        self.timestamps = [0.0] * capacity
+        # Running totals before each sample
+        self.totalsX = [0.0] * capacity
+        self.totalsY = [0.0] * capacity
+        # Sequence numbers of the oldest and one past the newest sample
+        self.start = 0
+        self.end = 0
+        self.totalX = 0.0
+        self.totalY = 0.0
+        # Sequence numbers of decreasing and increasing values, per tracked
+        # coordinate: x and y for dispersion, x + y for legacy
+        tracked = ('xs', 'ys') if mode == 'dispersion' else ('sums',)
+        self.extremes = [(name, deque(), deque()) for name in tracked]
+
+        self.inDwell = False
+        # Sequence number from which on the gaze stayed in range
+        self.settled = 0
+        self.progress = 0.0
+
+        # Blinks and dropouts reach us as gaps between samples. A gap longer
+        # than maxGap pauses the dwell timer: the missing time does not count.
+        # After more than maxPause the dwell starts over.
+        self.maxGap = maxGap
+        self.maxPause = maxPause
+        self.pausedTime = 0.0
+        self.lastTimestamp = None
+        self.lastInterval = 0.0
+        self.pauses = 0
+
+    def setDuration(self, duration):
+        self.minimumDelay = duration
+
+    def setRange(self, rangeInPixels):
+        self.range = rangeInPixels
+
+    def clear(self):
+        self.start = self.end
+        self.settled = self.end
+        self.progress = 0.0
+        self.totalX = 0.0
+        self.totalY = 0.0
+        for _, highs, lows in self.extremes:
+            highs.clear()
+            lows.clear()
+
+    def reset(self):
+        # Start over, as after a saccade: nothing before counts towards a dwell
+        self.clear()
+        self.inDwell = False
+        self.lastTimestamp = None
+
+    def grow(self):
+        capacity = self.capacity * 2
+        for name in ('xs', 'ys', 'sums', 'timestamps', 'totalsX', 'totalsY'):
+            old = getattr(self, name)
+            new = [0.0] * capacity
+            for sequence in range(self.start, self.end):
+                new[sequence % capacity] = old[sequence % self.capacity]
+            setattr(self, name, new)
+        self.capacity = capacity
+
+    def push(self, x, y, timestamp):
+        if self.end - self.start == self.capacity:
+            self.grow()
+
+        sequence = self.end
+        index = sequence % self.capacity
+        self.xs[index] = x
+        self.ys[index] = y
+        self.sums[index] = x + y
+        self.timestamps[index] = timestamp
+        self.totalsX[index] = self.totalX
+        self.totalsY[index] = self.totalY
+        self.totalX += x
+        self.totalY += y
+        self.end += 1
+
+        capacity = self.capacity
+        for name, highs, lows in self.extremes:
+            values = getattr(self, name)
+            value = values[index]
+            while highs and values[highs[-1] % capacity] <= value:
+                highs.pop()
+            highs.append(sequence)
+            while lows and values[lows[-1] % capacity] >= value:
+                lows.pop()
+            lows.append(sequence)
+
+    def popOldest(self):
+        self.start += 1
+
+        for _, highs, lows in self.extremes:
+            if highs[0] < self.start:
+                highs.popleft()
+            if lows[0] < self.start:
+                lows.popleft()
+
+    def extent(self, extreme, start):
+        # Highest and lowest value from sequence number start on. The deques
+        # hold the candidates for every suffix of the window in order, so a
+        # later start is a binary search away.
+        name, highs, lows = extreme
+        values = getattr(self, name)
+        if start == self.start:
+            return values[highs[0] % self.capacity], values[lows[0] % self.capacity]
+        high = highs[bisect_left(highs, start)]
+        low = lows[bisect_left(lows, start)]
+        return values[high % self.capacity], values[low % self.capacity]
+
+    def measure(self, start, rangeInPixels):
+        # Whether the samples from sequence number start on form a dwell, and their center
+        count = self.end - start
+        oldest = start % self.capacity
+        center = ((self.totalX - self.totalsX[oldest]) / count, (self.totalY - self.totalsY[oldest]) / count)
+
+        if self.mode == 'dispersion':
+            highX, lowX = self.extent(self.extremes[0], start)
+            highY, lowY = self.extent(self.extremes[1], start)
+            inDwell = max(highX - lowX, highY - lowY) < 2*rangeInPixels
+        else:
+            centerSum = center[0] + center[1]
+            high, low = self.extent(self.extremes[0], start)
+            inDwell = max(high - centerSum, centerSum - low) < rangeInPixels
+
+        return inDwell, center
+
+    def updateProgress(self, timestamp, start, duration, rangeInPixels):
+        # Progress outside of a dwell, for the window from sequence number
+        # start on: since when has the gaze stayed in range? In dispersion
+        # mode a suffix that left the range never comes back into it, so the
+        # settled start only moves forward, amortized one measure per sample.
+        # Legacy mode measures around the centroid, which moves, so there
+        # this is an approximation. With no range at all only the newest
+        # sample is settled.
+        settled = max(self.settled, start)
+        while settled < self.end - 1 and not self.measure(settled, rangeInPixels)[0]:
+            settled += 1
+        self.settled = settled
+
+        if duration <= 0:
+            self.progress = 0.0
+        else:
+            self.progress = min(1.0, (timestamp - self.timestamps[settled % self.capacity]) / duration)
+
+    def adjustTimestamp(self, timestamp):
+        # The timestamp with the paused time taken out; restarts after long gaps
+        if self.lastTimestamp is not None:
+            interval = timestamp - self.lastTimestamp
+            if interval > self.maxPause:
+                self.clear()
+            elif interval > self.maxGap:
+                self.pausedTime += interval - self.lastInterval
+                self.pauses += 1
+            else:
+                self.lastInterval = interval
+        self.lastTimestamp = timestamp
+        return timestamp - self.pausedTime
+
+    def addPoint(self, x, y, timestamp):
+        timestamp = self.adjustTimestamp(timestamp)
+
+        self.push(x, y, timestamp)
+        if timestamp - self.timestamps[self.start % self.capacity] < self.minimumDelay:
+            self.updateProgress(timestamp, self.start, self.minimumDelay, self.range)
+            return False, False, None
+
+        minTimestamp = timestamp - self.minimumDelay - .0001
+        while self.timestamps[self.start % self.capacity] < minTimestamp:
+            self.popOldest()
+
+        inDwell, center = self.measure(self.start, self.range)
+        changed = inDwell != self.inDwell
+        self.inDwell = inDwell
+        if inDwell:
+            self.progress = 1.0
+        else:
+            self.updateProgress(timestamp, self.start, self.minimumDelay, self.range)
+
+        return changed, inDwell, center
+
+
+class DwellPolicy():
+    # A dwell duration and radius for the gaze inside zone, a (left, top,
+    # right, bottom) rectangle in the coordinates the detector is fed
+    def __init__(self, name, duration, rangeInPixels, zone=None):
+        self.name = name
+        self.duration = duration
+        self.range = rangeInPixels
+        self.zone = zone
+        # Sequence number where this policy's window starts in the shared one
+        self.start = 0
+        self.inDwell = False
+
+    def contains(self, x, y):
+        if self.zone is None:
+            return True
+        left, top, right, bottom = self.zone
+        return left <= x < right and top <= y < bottom
+
+
+class ZonedDwellDetector(DwellDetector):
+    # Several dwell policies served from one sample window: the first policy
+    # whose zone holds the newest sample decides, the detector's own duration
+    # and range apply everywhere else. Samples are stored, pause-adjusted and
+    # tracked for extremes once, for the longest duration of all. A policy
+    # only keeps where its own window starts in the shared one, and its
+    # extremes are found by DwellDetector.extent on that suffix.
+    def __init__(self, minimumDelayInSeconds, rangeInPixels, policies=(), **options):
+        super().__init__(minimumDelayInSeconds, rangeInPixels, **options)
+        self.default = DwellPolicy('default', minimumDelayInSeconds, rangeInPixels)
+        self.policy = self.default
+        self.setPolicies(policies)
+
+    def setPolicies(self, policies):
+        self.policies = list(policies)
+        self.longest = max([self.default.duration] + [policy.duration for policy in self.policies])
+
+    def setDuration(self, duration):
+        super().setDuration(duration)
+        self.default.duration = duration
+        self.setPolicies(self.policies)
+
+    def setRange(self, rangeInPixels):
+        super().setRange(rangeInPixels)
+        self.default.range = rangeInPixels
+
+    def reset(self):
+        super().reset()
+        self.policy.inDwell = False
+
+    def policyAt(self, x, y):
+        for policy in self.policies:
+            if policy.contains(x, y):
+                return policy
+        return self.default
+
+    def addPoint(self, x, y, timestamp):
+        timestamp = self.adjustTimestamp(timestamp)
+        self.push(x, y, timestamp)
+
+        # Leaving a zone ends the dwell of its policy
+        policy = self.policyAt(x, y)
+        if policy is not self.policy:
+            self.policy.inDwell = False
+            self.policy = policy
+            # Another range: find where the gaze settled all over again
+            self.settled = self.start
+
+        # The policy's window is handled exactly like DwellDetector's own
+        result = False, False, None
+        inDwell = False
+        policy.start = max(policy.start, self.start)
+        if timestamp - self.timestamps[policy.start % self.capacity] >= policy.duration:
+            minTimestamp = timestamp - policy.duration - .0001
+            while self.timestamps[policy.start % self.capacity] < minTimestamp:
+                policy.start += 1
+
+            inDwell, center = self.measure(policy.start, policy.range)
+            result = inDwell != policy.inDwell, inDwell, center
+            policy.inDwell = inDwell
+            self.inDwell = inDwell
+
+        if inDwell:
+            self.progress = 1.0
+        else:
+            self.updateProgress(timestamp, policy.start, policy.duration, policy.range)
+
+        # Only then is the shared window cut to what the longest policy needs
+        minTimestamp = timestamp - self.longest - .0001
+        while self.timestamps[self.start % self.capacity] < minTimestamp:
+            self.popOldest()
+
+        return result
+
+
+class TargetDwell():
+    # Target-aware dwell: every target keeps the time the gaze spent on it and
+    # fires once that reaches minimumDelay, even if the gaze was not on it all
+    # along. Looking away for up to tolerance seconds costs the target
+    # nothing; longer excursions drain its time at decay seconds per second.
+    # addPoint takes the target under the gaze (None for none) and returns
+    # the target that fired, if any. Like a dwell, a target fires once per
+    # visit: it only starts over after the gaze left it for longer than
+    # tolerance.
+    #
+    # Only the target under the gaze is touched per sample. The others are
+    # drained lazily when the gaze comes back, so a sample costs O(1) however
+    # many targets there are. Gaps longer than maxGap (blinks, dropouts) are
+    # not counted, as in DwellDetector. progress is the accumulated time of
+    # the target under the gaze over minimumDelay, 1 while a fired target is
+    # still looked at.
+    def __init__(self, minimumDelayInSeconds, tolerance=0.2, decay=1.0, maxGap=0.1):
+        self.minimumDelay = minimumDelayInSeconds
+        self.tolerance = tolerance
+        self.decay = decay
+        self.maxGap = maxGap
+
+        # Target -> (accumulated seconds, clock when last looked at)
+        self.accumulated = {}
+        # Seconds of gaze seen, pauses left out
+        self.clock = 0.0
+        self.lastTimestamp = None
+        self.fired = None
+        self.progress = 0.0
+
+    def setDuration(self, duration):
+        self.minimumDelay = duration
+
+    def clear(self):
+        self.accumulated.clear()
+        self.fired = None
+
+    def addPoint(self, target, timestamp):
+        interval = 0.0
+        if self.lastTimestamp is not None:
+            interval = timestamp - self.lastTimestamp
+            if interval > self.maxGap:
+                interval = 0.0
+        self.lastTimestamp = timestamp
+        previousClock = self.clock
+        self.clock += interval
+
+        if target is None:
+            self.progress = 0.0
+            return None
+
+        seconds, lastSeen = self.accumulated.get(target, (0.0, previousClock))
+        away = previousClock - lastSeen
+        if target == self.fired:
+            if away <= self.tolerance:
+                self.accumulated[target] = (0.0, self.clock)
+                self.progress = 1.0
+                return None
+            self.fired = None
+        elif away > self.tolerance:
+            seconds = max(0.0, seconds - self.decay*(away - self.tolerance))
+        # The time since the last sample counts for where the gaze is now
+        seconds += interval
+
+        if seconds >= self.minimumDelay:
+            self.clear()
+            self.fired = target
+            self.accumulated[target] = (0.0, self.clock)
+            self.progress = 1.0
+            return target
+
+        self.accumulated[target] = (seconds, self.clock)
+        self.progress = seconds / self.minimumDelay
+        return None
+
+
+# Dwell starts and ends found by detectDwells: the index of the sample that
+# caused each, whether it started a dwell, its timestamp and the window center
+DwellEvents = namedtuple('DwellEvents', ['indices', 'starts', 'timestamps', 'centers'])
+
+
+def pauseAdjusted(timestamps, maxGap, maxPause, resets):
+    # The timestamps DwellDetector.addPoint works with, and where it restarts.
+    # The interval up to a sample that follows a reset is never looked at.
+    intervals = np.diff(timestamps)
+    counted = np.ones(len(intervals), dtype=bool)
+    counted[resets[resets > 0] - 1] = False
+    restarts = np.flatnonzero(counted & (intervals > maxPause)) + 1
+    pauses = counted & (intervals > maxGap) & (intervals <= maxPause)
+
+    # The last interval up to maxGap before each one, 0 before the first
+    kept = np.where(counted & (intervals <= maxGap), np.arange(len(intervals)), -1)
+    kept = np.maximum.accumulate(np.concatenate([[-1], kept[:-1]])) if len(kept) else kept
+    lastIntervals = np.where(kept >= 0, intervals[np.maximum(kept, 0)], 0.0)
+
+    pausedTime = np.cumsum(np.concatenate([[0.0], np.where(pauses, intervals - lastIntervals, 0.0)]))
+    return timestamps - pausedTime, restarts
+
+
+def trimSteps(timestamps, minimumDelay):
+    # For one stretch without restarts: which samples get past the minimum
+    # delay check of addPoint and where their trimmed window starts. A sample
+    # is checked against the window start left by the last one that got past,
+    # so this walks runs of passing samples, each found with a vectorized scan
+    count = len(timestamps)
+    passed = np.zeros(count, dtype=bool)
+    windowStarts = np.zeros(count, dtype=np.int64)
+    firstKept = np.searchsorted(timestamps, timestamps - minimumDelay - .0001, 'left')
+
+    start = 0
+    index = 0
+    while index < count:
+        # The first sample from index on that is minimumDelay past start
+        nextIndex = max(index, np.searchsorted(timestamps, timestamps[start] + minimumDelay, 'left'))
+        while nextIndex > index and not timestamps[nextIndex - 1] - timestamps[start] < minimumDelay:
+            nextIndex -= 1
+        while nextIndex < count and timestamps[nextIndex] - timestamps[start] < minimumDelay:
+            nextIndex += 1
+        if nextIndex >= count:
+            break
+
+        # Consecutive samples keep passing until one is too close to the
+        # window start the previous one left behind
+        index = nextIndex
+        block = 64
+        while True:
+            stop = min(index + block, count)
+            starts = np.maximum(start, firstKept[index:stop])
+            passed[index:stop] = True
+            windowStarts[index:stop] = starts
+            following = timestamps[index + 1:stop + 1] - timestamps[starts[:len(timestamps[index + 1:stop + 1])]]
+            failed = np.flatnonzero(following < minimumDelay)
+            if len(failed):
+                last = index + failed[0]
+                passed[last + 1:stop] = False
+                start = windowStarts[last]
+                index = last + 2
+                break
+            if stop >= count:
+                return passed, windowStarts
+            start = starts[-1]
+            index = stop
+            block *= 2
+
+    return passed, windowStarts
+
+
+def rangeTable(values, reduce):
+    # Sparse table: level k holds reduce over the 2**k values from each index
+    table = [values]
+    width = 1
+    while 2*width <= len(values):
+        previous = table[-1]
+        table.append(reduce(previous[:-width], previous[width:]))
+        width *= 2
+    return table
+
+
+def rangeQuery(table, reduce, starts, ends):
+    # reduce over values[starts[i]:ends[i] + 1]
+    levels = np.floor(np.log2(ends - starts + 1)).astype(np.int64)
+    result = np.empty(len(starts))
+    for level in np.unique(levels):
+        selected = levels == level
+        values = table[level]
+        result[selected] = reduce(values[starts[selected]], values[ends[selected] - (1 << level) + 1])
+    return result
+
+
+def detectDwells(samples, minimumDelayInSeconds, rangeInPixels, mode='dispersion', maxGap=0.1, maxPause=1.0, resets=()):
+    # Offline counterpart of DwellDetector for a whole recording: samples is
+    # an (N, 3) array of x, y and timestamp in order. Finds the same dwell
+    # starts and ends, with the same centers to the last bit, as feeding the
+    # samples one by one to DwellDetector.addPoint, calling reset before the
+    # samples whose indices are in resets.
+    if mode not in DwellDetector.modes:
+        raise ValueError(f'Unknown dwell mode {mode!r}, expected one of {DwellDetector.modes}')
+
+    samples = np.asarray(samples, dtype=np.float64).reshape(-1, 3)
+    xs, ys, timestamps = samples[:, 0], samples[:, 1], samples[:, 2]
+    count = len(samples)
+    if count == 0:
+        return DwellEvents(np.empty(0, dtype=np.int64), np.empty(0, dtype=bool), np.empty(0), np.empty((0, 2)))
+
+    resets = np.unique(np.asarray(resets, dtype=np.int64))
+    adjusted, restarts = pauseAdjusted(timestamps, maxGap, maxPause, resets)
+    bounds = np.union1d(np.concatenate([[0], restarts, resets]), [count]).astype(np.int64)
+
+    passed = np.zeros(count, dtype=bool)
+    windowStarts = np.zeros(count, dtype=np.int64)
+    totalsX = np.empty(count)
+    totalsY = np.empty(count)
+    before = np.empty((2, count))
+    for first, stop in zip(bounds[:-1], bounds[1:]):
+        segmentPassed, segmentStarts = trimSteps(adjusted[first:stop], minimumDelayInSeconds)
+        passed[first:stop] = segmentPassed
+        windowStarts[first:stop] = segmentStarts + first
+        # Running totals since the restart, as the streaming detector keeps them
+        totalsX[first:stop] = np.cumsum(xs[first:stop])
+        totalsY[first:stop] = np.cumsum(ys[first:stop])
+        before[0, first] = before[1, first] = 0.0
+        before[0, first + 1:stop] = totalsX[first:stop - 1]
+        before[1, first + 1:stop] = totalsY[first:stop - 1]
+
+    ends = np.flatnonzero(passed)
+    starts = windowStarts[ends]
+    sizes = ends - starts + 1
+    centers = np.column_stack([(totalsX[ends] - before[0, starts]) / sizes, (totalsY[ends] - before[1, starts]) / sizes])
+
+    if mode == 'dispersion':
+        spreads = []
+        for values in (xs, ys):
+            highs = rangeQuery(rangeTable(values, np.maximum), np.maximum, starts, ends)
+            lows = rangeQuery(rangeTable(values, np.minimum), np.minimum, starts, ends)
+            spreads.append(highs - lows)
+        inDwell = np.maximum(spreads[0], spreads[1]) < 2*rangeInPixels
+    else:
+        sums = xs + ys
+        centerSums = centers[:, 0] + centers[:, 1]
+        highs = rangeQuery(rangeTable(sums, np.maximum), np.maximum, starts, ends)
+        lows = rangeQuery(rangeTable(sums, np.minimum), np.minimum, starts, ends)
+        inDwell = np.maximum(highs - centerSums, centerSums - lows) < rangeInPixels
+
+    # A reset leaves the detector out of any dwell; a restart does not
+    previous = np.concatenate([[False], inDwell[:-1]])
+    afterReset = np.searchsorted(resets, ends, side='right')
+    previous[1:][afterReset[1:] != afterReset[:-1]] = False
+    changed = inDwell != previous
+    indices = ends[changed]
+    return DwellEvents(indices, inDwell[changed], timestamps[indices], centers[changed])
@@ -0,0 +1,353 @@
+import argparse
+import itertools
+import os
+import runpy
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from dwell import DwellDetector, detectDwells
+from gaze_filters import VelocityClassifier, centeredAverage, filterTypes
+from gaze_synthetic import SyntheticGaze
+
+# Offline tuning of dwell time, dwell radius and smoothing. Sessions are
+# replayed through the gaze filter, the fixation/saccade classification and
+# DwellDetector the way PupilPointerApp.poll runs them, for every combination
+# of the values given, spread over a process pool. Reported per combination,
+# summed over the sessions:
+#   selected  activations of a target the participant meant to select
+#   false     activations of anything else, or of a meant target again
+#   missed    meant targets that were never activated
+#   time      mean time from first looking at a meant target to activating it
+#
+# The targets and hit-testing come from the interface's own TagWindow at the
+# given size, loaded offscreen without its mouse control and audio. A target
+# counts as meant when the gaze stayed on it for at least --intent seconds:
+# the noise-free path of synthetic gaze, or a 100 ms moving average of
+# recorded gaze.
+#
+# Without recordings synthetic sessions are used. Recordings made with
+# GazeWorker(recordTo=...) are mapped onto the interface's surface first,
+# once per recording.
+#
+# Usage: python dwell_sweep.py [recording ...] [--interface "Interface 1"]
+#        [--times 0.3:1.5:0.05] [--radii 10:100:5] [--smoothing 0.5:0.95:0.05]
+
+Session = namedtuple('Session', ['name', 'samples', 'transform', 'targetMap', 'intents'])
+
+options = None
+sessions = None
+
+
+def parseRange(text):
+    # start:stop:step, stop included, or a comma separated list
+    if ':' in text:
+        start, stop, step = (float(value) for value in text.split(':'))
+        return np.round(np.arange(start, stop + step/2, step), 6).tolist()
+    return [float(value) for value in text.split(',')]
+
+
+class Inert():
+    # Stands in for a module the sweep must not touch: every attribute is
+    # another Inert and every call returns one
+    def __getattr__(self, name):
+        return Inert()
+
+    def __call__(self, *args, **kwargs):
+        return Inert()
+
+
+def loadInterface(path, size):
+    # A TagWindow of the interface script at the given size, offscreen. Only
+    # its geometry is used, so pyautogui (which needs a display) and
+    # fluidsynth (which opens the audio device) are replaced while it loads.
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    from PySide6.QtWidgets import QApplication
+
+    app = QApplication.instance() or QApplication([])
+    replaced = {name: sys.modules.get(name) for name in ('pyautogui', 'fluidsynth')}
+    sys.modules.update((name, Inert()) for name in replaced)
+    try:
+        interface = runpy.run_path(path, run_name='interface')
+        tagWindow = interface['TagWindow']()
+    finally:
+        for name, module in replaced.items():
+            if module is None:
+                del sys.modules[name]
+            else:
+                sys.modules[name] = module
+    tagWindow.resize(*size)
+    return app, tagWindow
+
+
+def sampleRuns(lookup, length, step):
+    # [lookup(i) for i in range(length)] for a lookup that only changes value
+    # after runs of at least step indices: every step-th index is looked up,
+    # and where two lookups differ the change in between is found by bisection
+    values = [None] * length
+    position, value = 0, lookup(0)
+    while position < length - 1:
+        probe = min(position + step, length - 1)
+        probeValue = lookup(probe)
+        if probeValue != value:
+            low = position
+            while probe - low > 1:
+                middle = (low + probe) // 2
+                middleValue = lookup(middle)
+                if middleValue == value:
+                    low = middle
+                else:
+                    probe, probeValue = middle, middleValue
+        values[position:probe] = [value] * (probe - position)
+        position, value = probe, probeValue
+    values[position] = value
+    return values
+
+
+def rasterizeTargets(tagWindow, size, step=8):
+    # Target index under every widget pixel, -1 for none, so hit-testing a
+    # whole session is one lookup. Targets and the gaps between them are wider
+    # than step pixels, so rows and columns are sampled with sampleRuns
+    # instead of hit-testing every pixel.
+    width, height = size
+
+    def targetAt(x, y):
+        target = tagWindow.getTargetAt(x + 0.5, y + 0.5)
+        return -1 if target is None else target
+
+    def row(y):
+        return tuple(sampleRuns(lambda x: targetAt(x, y), width, step))
+
+    return np.array(sampleRuns(row, height, step), dtype=np.int16)
+
+
+def hitTest(targetMap, points):
+    height, width = targetMap.shape
+    columns = np.floor(points[:, 0]).astype(np.int64)
+    rows = np.floor(points[:, 1]).astype(np.int64)
+    inside = (columns >= 0) & (columns < width) & (rows >= 0) & (rows < height)
+    targets = np.full(len(points), -1, dtype=np.int64)
+    targets[inside] = targetMap[rows[inside], columns[inside]]
+    return targets
+
+
+def findIntents(targets, timestamps, intent):
+    # (target, first, last timestamp) of every stretch of at least intent
+    # seconds on one target; gaps in the samples do not end a stretch
+    changes = np.flatnonzero(np.diff(targets)) + 1
+    starts = np.concatenate([[0], changes])
+    stops = np.concatenate([changes, [len(targets)]]) - 1
+    intents = [
+        (targets[start], timestamps[start], timestamps[stop])
+        for start, stop in zip(starts, stops)
+        if targets[start] >= 0 and timestamps[stop] - timestamps[start] >= intent
+    ]
+    return np.array(intents, dtype=np.float64).reshape(-1, 3)
+
+
+def syntheticSession(index, transform, targetMap, surfaceTargets, seconds, rate):
+    # Normalized targets, visited in a shuffled order
+    surfaceTargets = np.array(surfaceTargets)
+    order = np.random.default_rng(index).permutation(len(surfaceTargets))
+    noisy = SyntheticGaze(rate, surfaceTargets[order], fixationDuration=1.2, seed=index)
+    exact = SyntheticGaze(rate, surfaceTargets[order], fixationDuration=1.2, jitter=0.0, seed=index)
+    noisy.start(0.0)
+    exact.start(0.0)
+    samples, _ = noisy.generate(seconds)
+    truth, _ = exact.generate(seconds)
+
+    truthPixels = truth[:, :2] @ transform[:, :2].T + transform[:, 2]
+    intents = findIntents(hitTest(targetMap, truthPixels), truth[:, 2], options.intent)
+    return Session(f'synthetic {index + 1}', samples, transform, targetMap, intents)
+
+
+def mapRecording(path, markerVerts, size):
+    # Surface gaze of a recording, the way GazeWorker maps it: matched frames
+    # through the GazeMapper, full-rate gaze through a SurfaceCache. Only
+    # recordings need the device stack, synthetic sweeps run without it.
+    from pupil_labs.real_time_screen_gaze.gaze_mapper import GazeMapper
+
+    from gaze_recording import ReplayDevice
+    from marker_pool import eyeOpen, readMapperResult
+    from surface_tracking import SurfaceCache
+
+    device = ReplayDevice(path, realtime=False)
+    gazeMapper = GazeMapper(device.get_calibration())
+    rows = []
+
+    if device.streams['matched']:
+        surface = gazeMapper.add_surface(markerVerts, size)
+        for event in device.streams['matched']:
+            gaze = device.toGaze(event['gaze'])
+            _, points = readMapperResult(gazeMapper.process_frame(device.toFrame(event), gaze), surface)
+            if eyeOpen(gaze):
+                rows += [(x, y, gaze.timestamp_unix_seconds) for x, y in points]
+    else:
+        surfaceCache = SurfaceCache(gazeMapper, device.get_calibration())
+        surfaceCache.setSurface(markerVerts, size, 'sweep')
+        events = sorted(device.streams['gaze'] + device.streams['frame'], key=lambda event: event['receivedAt'])
+        latestGaze = None
+        for event in events:
+            if event['kind'] == 'frame':
+                if latestGaze is not None:
+                    surfaceCache.process_frame(device.toFrame(event), latestGaze)
+                continue
+
+            latestGaze = device.toGaze(event['gaze'])
+            point = surfaceCache.mapGaze(latestGaze.x, latestGaze.y)
+            if point is not None and eyeOpen(latestGaze):
+                rows.append((*point, latestGaze.timestamp_unix_seconds))
+
+    samples = np.array(rows, dtype=np.float64).reshape(-1, 3)
+    return samples[np.argsort(samples[:, 2], kind='stable')]
+
+
+def recordedSession(path, markerVerts, transform, targetMap, size):
+    samples = mapRecording(path, markerVerts, size)
+
+    # The participant's intent is judged on a centered 100 ms average
+    referencePixels = centeredAverage(samples, 0.1) @ transform[:, :2].T + transform[:, 2]
+    intents = findIntents(hitTest(targetMap, referencePixels), samples[:, 2], options.intent)
+    return Session(str(path), samples, transform, targetMap, intents)
+
+
+def startWorker(sharedOptions, sharedSessions):
+    global options, sessions
+    options = sharedOptions
+    sessions = sharedSessions
+
+
+def filterSession(session, smoothing):
+    # Filtered widget pixels and the indices DwellDetector would see, in
+    # batches as poll gets them; saccade samples reset it and are left out
+    gazeFilter = filterTypes[options.filter](smoothing)
+    classifier = VelocityClassifier()
+    samples = session.samples
+    filtered = np.empty((len(samples), 2))
+    labels = np.empty(len(samples), dtype='<U8')
+    for start in range(0, len(samples), 8):
+        batch = samples[start:start + 8]
+        filtered[start:start + 8] = gazeFilter.filterBatch(batch[:, :2], batch[:, 2])
+        labels[start:start + 8] = classifier.classify(batch[:, :2], filtered[start:start + 8], batch[:, 2])
+
+    pixels = filtered @ session.transform[:, :2].T + session.transform[:, 2]
+    if not options.classify:
+        return pixels, np.arange(len(samples)), np.empty(0, dtype=np.int64)
+
+    kept = np.flatnonzero(labels != 'saccade')
+    # Reset before every kept sample that follows a saccade
+    resets = np.flatnonzero(np.diff(kept, prepend=-1) > 1)
+    return pixels, kept, resets
+
+
+def scoreActivations(session, timestamps, targets):
+    # Every meant target is selected at most once, by the first activation of
+    # it while the gaze is on it (or just after, as a click lands late)
+    intents = session.intents
+    used = np.zeros(len(intents), dtype=bool)
+    selectionTimes = []
+    false = 0
+    for timestamp, target in zip(timestamps, targets):
+        candidates = np.flatnonzero(
+            (intents[:, 0] == target) & (intents[:, 1] <= timestamp) & (timestamp <= intents[:, 2] + 0.1)
+        )
+        if len(candidates) and not used[candidates[0]]:
+            used[candidates[0]] = True
+            selectionTimes.append(timestamp - intents[candidates[0], 1])
+        else:
+            false += 1
+
+    return len(selectionTimes), false, int(np.count_nonzero(~used)), sum(selectionTimes)
+
+
+def evaluate(task):
+    # All dwell times and radii of one session and smoothing
+    sessionIndex, smoothing = task
+    session = sessions[sessionIndex]
+    pixels, kept, resets = filterSession(session, smoothing)
+    dwellSamples = np.column_stack([pixels[kept], session.samples[kept, 2]])
+
+    results = []
+    for dwellTime, radius in itertools.product(options.times, options.radii):
+        events = detectDwells(dwellSamples, dwellTime, radius, mode=options.mode, resets=resets)
+        centers = events.centers[events.starts]
+        activated = hitTest(session.targetMap, centers)
+        scores = scoreActivations(session, events.timestamps[events.starts], activated)
+        results.append(((smoothing, dwellTime, radius), scores))
+    return results
+
+
+def main():
+    global options, sessions
+
+    parser = argparse.ArgumentParser(description='Sweep dwell and smoothing settings over recorded or synthetic gaze')
+    parser.add_argument('recordings', nargs='*', help='recording directories; synthetic gaze without any')
+    parser.add_argument('--interface', default='Interface 1', help='interface script whose targets are used')
+    parser.add_argument('--size', default='1920x1080', help='window size in pixels, WIDTHxHEIGHT')
+    parser.add_argument('--times', type=parseRange, default='0.3:1.5:0.05', help='dwell times in seconds')
+    parser.add_argument('--radii', type=parseRange, default='10:100:5', help='dwell radii in pixels')
+    parser.add_argument('--smoothing', type=parseRange, default='0.5:0.95:0.05', help='smoothing values')
+    parser.add_argument('--filter', default='Exponential', choices=list(filterTypes), help='gaze filter')
+    parser.add_argument('--mode', default='dispersion', choices=DwellDetector.modes, help='DwellDetector mode')
+    parser.add_argument('--no-classify', dest='classify', action='store_false', help='feed saccades to dwell detection too')
+    parser.add_argument('--intent', type=float, default=1.0, help='seconds on a target that count as meaning it')
+    parser.add_argument('--synthetic', type=int, default=3, help='synthetic sessions without recordings')
+    parser.add_argument('--seconds', type=float, default=60.0, help='length of synthetic sessions')
+    parser.add_argument('--rate', type=float, default=200.0, help='sampling rate of synthetic sessions')
+    parser.add_argument('--processes', type=int, default=os.cpu_count(), help='worker processes')
+    parser.add_argument('--top', type=int, default=15, help='combinations to show')
+    parser.add_argument('--csv', help='write every combination to this file')
+    options = parser.parse_args()
+
+    size = tuple(int(value) for value in options.size.split('x'))
+    _, tagWindow = loadInterface(options.interface, size)
+    transform = tagWindow.getSurfaceTransform()
+    targetMap = rasterizeTargets(tagWindow, size)
+
+    if options.recordings:
+        sessions = [
+            recordedSession(path, tagWindow.getMarkerVerts(), transform, targetMap, size)
+            for path in options.recordings
+        ]
+    else:
+        sessions = [
+            syntheticSession(index, transform, targetMap, tagWindow.getSurfaceTargets(), options.seconds, options.rate)
+            for index in range(options.synthetic)
+        ]
+    for session in sessions:
+        print(f'{session.name}: {len(session.samples)} samples, {len(session.intents)} meant targets')
+
+    tasks = list(itertools.product(range(len(sessions)), options.smoothing))
+    combinations = len(options.smoothing) * len(options.times) * len(options.radii)
+    print(f'Sweeping {combinations} combinations over {len(sessions)} sessions in {options.processes} processes')
+
+    start = time.perf_counter()
+    totals = {}
+    with ProcessPoolExecutor(options.processes, initializer=startWorker, initargs=(options, sessions)) as pool:
+        for results in pool.map(evaluate, tasks):
+            for key, scores in results:
+                totals[key] = np.add(totals.get(key, 0), scores)
+    print(f'Done in {time.perf_counter() - start:.1f} s')
+
+    rows = []
+    for (smoothing, dwellTime, radius), (selected, false, missed, selectionTime) in totals.items():
+        meanTime = selectionTime/selected if selected else float('inf')
+        rows.append((false + missed, meanTime, smoothing, dwellTime, radius, selected, false, missed))
+    rows.sort()
+
+    print(' smoothing  time  radius  selected  false  missed  selection time')
+    for errors, meanTime, smoothing, dwellTime, radius, selected, false, missed in rows[:options.top]:
+        print(f'{smoothing:10.2f} {dwellTime:5.2f} {radius:7.0f} {selected:9.0f} {false:6.0f} {missed:7.0f} {meanTime:12.3f} s')
+
+    if options.csv:
+        with open(options.csv, 'w') as output:
+            output.write('smoothing,dwell_time,dwell_radius,selected,false,missed,mean_selection_time\n')
+            for errors, meanTime, smoothing, dwellTime, radius, selected, false, missed in rows:
+                output.write(f'{smoothing},{dwellTime},{radius},{selected:.0f},{false:.0f},{missed:.0f},{meanTime:.4f}\n')
+
+
+if __name__ == '__main__':
+    main()
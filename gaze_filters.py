@@ -0,0 +1,386 @@
+import math
+
+import numpy as np
+
+
+# Gaze filters share one interface, so PupilPointerApp can swap them:
+#   filterBatch(points, timestamps)  (N, 2) positions and their N timestamps
+#                                    in, the filtered (N, 2) positions out, in
+#                                    a buffer the next call overwrites
+#   setSmoothing(smoothing)          the 0 to 1 smoothing knob of the settings
+#   lag()                            delay behind steadily moving gaze, in samples
+#   reset()
+# Output buffers only grow, so once warmed up filtering allocates no arrays.
+
+
+class ExponentialSmoother():
+    # The exponential moving average PupilPointerApp always used,
+    #   y[k] = s*y[k-1] + (1-s)*x[k],
+    # run over a whole batch of samples at once. Unrolled, every output is a
+    # weighted sum of the inputs so far plus a decayed copy of the previous
+    # output, which is one matrix product with a lower triangular weight
+    # matrix, the decay being its first column.
+    def __init__(self, smoothing):
+        self.smoothing = smoothing
+        self.position = None
+        self.weights = np.empty((0, 1))
+        # The previous output followed by the batch, and the smoothed batch
+        self.input = np.empty((1, 2))
+        self.output = np.empty((0, 2))
+
+    def setSmoothing(self, smoothing):
+        self.smoothing = smoothing
+        self.weights = np.empty((0, 1))
+
+    def reset(self):
+        self.position = None
+
+    def lag(self):
+        # Delay of the smoothed signal behind a steadily moving input, in samples
+        if self.smoothing >= 1.0:
+            return float('inf')
+        return self.smoothing / (1.0 - self.smoothing)
+
+    def prepare(self, count):
+        # Weights only depend on the smoothing and the batch size; grow as needed
+        if len(self.weights) >= count:
+            return
+
+        s = self.smoothing
+        k = np.arange(count)
+        exponents = k[:, None] - k[None, :]
+        weights = np.where(exponents >= 0, (1.0 - s) * s ** np.maximum(exponents, 0), 0.0)
+        self.weights = np.column_stack([s ** (k + 1), weights])
+        self.input = np.empty((count + 1, 2))
+        self.output = np.empty((count, 2))
+
+    def filterBatch(self, points, timestamps=None):
+        # Samples are weighted alike whatever their spacing, so the timestamps
+        # are not needed
+        points = np.asarray(points, dtype=np.float64)
+        count = len(points)
+        if count == 0:
+            return points
+
+        if self.position is None:
+            # The first sample is taken as is, as it always was
+            self.position = points[0].copy()
+            if count == 1:
+                return points.copy()
+            return np.vstack([points[:1], self.filterBatch(points[1:])])
+
+        self.prepare(count)
+        self.input[0] = self.position
+        self.input[1:count + 1] = points
+        smoothed = self.output[:count]
+        np.matmul(self.weights[:count, :count + 1], self.input[:count + 1], out=smoothed)
+        self.position[:] = smoothed[-1]
+        return smoothed
+
+
+# The smoothing knob was tuned for the exponential average at the scene
+# camera rate; the other filters map it to the settings that smooth a
+# fixation sampled at this rate just as much
+referenceRate = 30.0
+
+
+class OneEuroFilter():
+    # The One Euro filter (Casiez et al., CHI 2012): an exponential average
+    # whose cutoff frequency rises with the speed of the gaze, so fixations
+    # are smoothed hard while saccades and pursuit get through with little
+    # lag. The cutoff is minCutoff + beta*speed Hz, speed being in surface
+    # units per second and itself smoothed with a cutoff of speedCutoff Hz.
+    def __init__(self, smoothing, beta=5.0, speedCutoff=1.0):
+        self.beta = beta
+        self.speedCutoff = speedCutoff
+        self.output = np.empty((0, 2))
+        self.setSmoothing(smoothing)
+        self.reset()
+
+    def setSmoothing(self, smoothing):
+        # At referenceRate and standstill, weigh new samples by 1 - smoothing
+        smoothing = min(max(smoothing, 1e-3), 1.0)
+        self.smoothing = smoothing
+        self.minCutoff = (1.0 - smoothing) * referenceRate / (2*math.pi*smoothing)
+
+    def reset(self):
+        self.state = None
+        self.alpha = 1.0
+
+    def lag(self):
+        if self.alpha <= 0.0:
+            return float('inf')
+        return (1.0 - self.alpha) / self.alpha
+
+    @staticmethod
+    def weight(cutoff, interval):
+        # Weight of a new sample for an exponential average with this cutoff
+        r = 2*math.pi*cutoff*interval
+        return r / (r + 1.0)
+
+    def filterBatch(self, points, timestamps):
+        count = len(points)
+        if len(self.output) < count:
+            self.output = np.empty((count, 2))
+        filtered = self.output[:count]
+
+        for index, ((px, py), timestamp) in enumerate(zip(np.asarray(points).tolist(), np.asarray(timestamps).tolist())):
+            if self.state is None:
+                self.state = (px, py, 0.0, 0.0, timestamp)
+                filtered[index] = (px, py)
+                continue
+
+            x, y, dx, dy, last = self.state
+            interval = max(timestamp - last, 1e-4)
+            speedWeight = self.weight(self.speedCutoff, interval)
+            dx += speedWeight * ((px - x)/interval - dx)
+            dy += speedWeight * ((py - y)/interval - dy)
+
+            self.alpha = self.weight(self.minCutoff + self.beta*math.hypot(dx, dy), interval)
+            x += self.alpha * (px - x)
+            y += self.alpha * (py - y)
+            self.state = (x, y, dx, dy, timestamp)
+            filtered[index] = (x, y)
+
+        return filtered
+
+
+class KalmanFilter():
+    # Constant velocity Kalman filter, x and y alike and independent: the
+    # state is a position and a velocity, the acceleration is noise. Both axes
+    # see the same timestamps, so they share one covariance matrix, kept as
+    # its three distinct entries. Steady pursuit is followed without lag.
+    # Saccades are no constant velocity motion and would leave the filter
+    # ringing, so a measurement more than jumpDistance surface units from the
+    # prediction restarts it there.
+    def __init__(self, smoothing, jumpDistance=0.05):
+        self.jumpDistance = jumpDistance
+        self.output = np.empty((0, 2))
+        self.setSmoothing(smoothing)
+        self.reset()
+
+    def setSmoothing(self, smoothing):
+        # Only the ratio of process to measurement noise matters. It is chosen
+        # so the steady state position gain at referenceRate is 1 - smoothing,
+        # with the alpha-beta filter relations of Kalata (1984).
+        self.smoothing = smoothing
+        alpha = min(max(1.0 - smoothing, 1e-3), 0.999)
+        beta = 2*(2 - alpha) - 4*math.sqrt(1 - alpha)
+        tracking = beta*beta / (1 - alpha)
+        self.measurementNoise = 1.0
+        self.processNoise = tracking * self.measurementNoise * referenceRate**4
+
+    def reset(self):
+        self.state = None
+
+    def lag(self):
+        return 0.0
+
+    def filterBatch(self, points, timestamps):
+        count = len(points)
+        if len(self.output) < count:
+            self.output = np.empty((count, 2))
+        filtered = self.output[:count]
+        q = self.processNoise
+        r = self.measurementNoise
+
+        for index, ((px, py), timestamp) in enumerate(zip(np.asarray(points).tolist(), np.asarray(timestamps).tolist())):
+            if self.state is not None:
+                x, y, vx, vy, a, b, c, last = self.state
+                dt = max(timestamp - last, 0.0)
+                x += vx*dt
+                y += vy*dt
+                innovationX = px - x
+                innovationY = py - y
+
+            if self.state is None or math.hypot(innovationX, innovationY) > self.jumpDistance:
+                # Position as measured, velocity unknown
+                self.state = (px, py, 0.0, 0.0, r, 0.0, 1e6*r, timestamp)
+                filtered[index] = (px, py)
+                continue
+
+            # Predict the covariance, with piecewise constant acceleration of
+            # variance q
+            dt2 = dt*dt
+            a += 2*dt*b + dt2*c + q*dt2*dt2/4
+            b += dt*c + q*dt2*dt/2
+            c += q*dt2
+
+            # Update with the measured position
+            gainPosition = a / (a + r)
+            gainVelocity = b / (a + r)
+            x += gainPosition*innovationX
+            y += gainPosition*innovationY
+            vx += gainVelocity*innovationX
+            vy += gainVelocity*innovationY
+            a, b, c = (1 - gainPosition)*a, (1 - gainPosition)*b, c - gainVelocity*b
+
+            self.state = (x, y, vx, vy, a, b, c, timestamp)
+            filtered[index] = (x, y)
+
+        return filtered
+
+
+# The filters the settings offer, by name
+filterTypes = {
+    'Exponential': ExponentialSmoother,
+    'One Euro': OneEuroFilter,
+    'Kalman': KalmanFilter,
+}
+
+
+def spanSpeeds(history, first, span):
+    # Speed of the rows of history (x, y, timestamp) from index first on,
+    # relative to the newest row at least span seconds older. Rows without
+    # one get a speed of 0.
+    timestamps = history[:, 2]
+    new = np.arange(first, len(history))
+    earlier = np.searchsorted(timestamps, timestamps[new] - span, side='right') - 1
+    speeds = np.zeros(len(new))
+    valid = earlier >= 0
+    elapsed = np.maximum(timestamps[new[valid]] - timestamps[earlier[valid]], 1e-6)
+    speeds[valid] = np.hypot(*(history[new[valid], :2] - history[earlier[valid], :2]).T) / elapsed
+    return speeds
+
+
+def centeredAverage(samples, span):
+    # Offline reference for recorded gaze: the mean position of the (x, y,
+    # timestamp) rows of samples, sorted by time, within span/2 seconds on
+    # either side of every row
+    timestamps = samples[:, 2]
+    lower = np.searchsorted(timestamps, timestamps - span/2)
+    upper = np.searchsorted(timestamps, timestamps + span/2, side='right')
+    sums = np.vstack([np.zeros(2), np.cumsum(samples[:, :2], axis=0)])
+    return (sums[upper] - sums[lower]) / (upper - lower)[:, None]
+
+
+class VelocityClassifier():
+    # Streaming velocity threshold (I-VT) classification into 'fixation',
+    # 'saccade' and 'pursuit'. Speeds are in surface units per second, each
+    # relative to the sample a span earlier. Saccades are short and fast and
+    # smoothing would smear them out, so they are found in the raw gaze:
+    # faster than saccadeSpeed over saccadeSpan. Jitter hides slow pursuit in
+    # the raw gaze, so the rest is split on the smoothed gaze: faster than
+    # pursuitSpeed over pursuitSpan is pursuit, slower is fixation.
+    labels = ('fixation', 'pursuit', 'saccade')
+
+    def __init__(self, pursuitSpeed=0.15, saccadeSpeed=1.5, pursuitSpan=0.04, saccadeSpan=0.02):
+        self.pursuitSpeed = pursuitSpeed
+        self.saccadeSpeed = saccadeSpeed
+        self.pursuitSpan = pursuitSpan
+        self.saccadeSpan = saccadeSpan
+        self.reset()
+
+    def reset(self):
+        # (x, y, timestamp) rows still needed for the speed of the next samples
+        self.raw = np.empty((0, 3))
+        self.smoothed = np.empty((0, 3))
+        self.label = 'fixation'
+        self.counts = dict.fromkeys(self.labels, 0)
+
+    def speeds(self, history, points, timestamps, span):
+        # Speeds of the new points, and the history the next batch needs
+        history = np.vstack([history, np.column_stack([points, timestamps])])
+        speeds = spanSpeeds(history, len(history) - len(points), span)
+        return speeds, history[history[:, 2] >= history[-1, 2] - span]
+
+    def classify(self, raw, smoothed, timestamps):
+        # raw and smoothed are (N, 2) positions of one batch; returns N labels
+        saccadeSpeeds, self.raw = self.speeds(self.raw, raw, timestamps, self.saccadeSpan)
+        pursuitSpeeds, self.smoothed = self.speeds(self.smoothed, smoothed, timestamps, self.pursuitSpan)
+
+        labels = np.full(len(timestamps), 'fixation', dtype='<U8')
+        labels[pursuitSpeeds > self.pursuitSpeed] = 'pursuit'
+        labels[saccadeSpeeds > self.saccadeSpeed] = 'saccade'
+
+        for label in self.labels:
+            self.counts[label] += int(np.count_nonzero(labels == label))
+        if len(labels):
+            self.label = str(labels[-1])
+        return labels
+
+    def summary(self):
+        total = sum(self.counts.values())
+        if not total:
+            return 'no samples classified'
+        return ', '.join(f'{100*self.counts[label]/total:.0f}% {label}' for label in self.labels)
+
+
+class GazePredictor():
+    # Extrapolates smoothed gaze forward in time, to make up for the delay of
+    # the pipeline and of the smoothing itself. The velocity comes from a
+    # constant velocity model: the least squares slope of the smoothed
+    # positions over the last window seconds. That slope says nothing about
+    # more than window seconds, so the smoothing lag counts for at most that
+    # much, both in how far ahead the prediction reaches and in how long it
+    # waits after a saccade. With heavy smoothing at low rates it would
+    # otherwise extrapolate the smoothing's slow convergence and add jitter.
+    #
+    # Saccades end abruptly and would be overshot, so prediction is off while
+    # the raw gaze moves faster than saccadeSpeed (surface units per second,
+    # measured over speedSpan seconds to stay clear of jitter), and after it
+    # for settleTime plus three times the smoothing lag, while the smoothed
+    # position still converges on the landing point.
+    #
+    # Below fixationSpeed the velocity is mostly jitter; the prediction fades
+    # in between fixationSpeed and twice that so fixations are not made noisier.
+    # A slope over only a few samples, as right after a blink, is mostly jitter
+    # too, so nothing is predicted until the samples span half the window.
+    def __init__(self, window=0.1, fixationSpeed=0.12, saccadeSpeed=1.5, speedSpan=0.02, settleTime=0.05, maxHorizon=0.2):
+        self.window = window
+        self.fixationSpeed = fixationSpeed
+        self.saccadeSpeed = saccadeSpeed
+        self.speedSpan = speedSpan
+        self.settleTime = settleTime
+        self.maxHorizon = maxHorizon
+        self.reset()
+
+    def reset(self):
+        # (x, y, timestamp) rows of what is still inside the windows
+        self.raw = np.empty((0, 3))
+        self.smoothed = np.empty((0, 3))
+        self.saccadeEnd = -np.inf
+        self.active = False
+
+    def sampleInterval(self):
+        if len(self.smoothed) < 2:
+            return 0.0
+        return float(np.median(np.diff(self.smoothed[:, 2])))
+
+    def detectSaccade(self, raw):
+        # Speed of every new sample relative to the sample speedSpan earlier
+        history = np.vstack([self.raw, raw])
+        timestamps = history[:, 2]
+        fast = spanSpeeds(history, len(self.raw), self.speedSpan) > self.saccadeSpeed
+        if fast.any():
+            self.saccadeEnd = timestamps[len(self.raw):][fast][-1]
+
+        self.raw = history[timestamps >= timestamps[-1] - self.speedSpan]
+
+    def predict(self, raw, smoothed, timestamps, latency, smoothingLag=0.0):
+        # raw and smoothed are (N, 2) normalized positions of one batch; the
+        # newest smoothed position is moved ahead by latency seconds plus
+        # smoothingLag samples and returned
+        timestamps = np.asarray(timestamps, dtype=np.float64)
+        self.detectSaccade(np.column_stack([raw, timestamps]))
+
+        history = np.vstack([self.smoothed, np.column_stack([smoothed, timestamps])])
+        self.smoothed = history[history[:, 2] >= timestamps[-1] - self.window]
+
+        reach = min(self.maxHorizon, self.window)
+        lagSeconds = reach
+        if np.isfinite(smoothingLag):
+            lagSeconds = min(smoothingLag*self.sampleInterval(), reach)
+
+        position = self.smoothed[-1, :2]
+        settled = timestamps[-1] >= self.saccadeEnd + self.settleTime + 3*lagSeconds
+        covered = self.smoothed[-1, 2] - self.smoothed[0, 2] >= self.window/2
+        self.active = settled and covered and len(self.smoothed) >= 3
+        if not self.active:
+            return position.copy()
+
+        horizon = min(latency + lagSeconds, reach)
+        t = self.smoothed[:, 2] - self.smoothed[:, 2].mean()
+        velocity = t @ (self.smoothed[:, :2] - self.smoothed[:, :2].mean(axis=0)) / (t @ t)
+        gain = np.clip(np.hypot(*velocity)/self.fixationSpeed - 1.0, 0.0, 1.0)
+        return position + gain*velocity*horizon
@@ -0,0 +1,621 @@
+import os
+import threading
+import time
+from collections import deque, namedtuple
+from pathlib import Path
+
+import numpy as np
+from pupil_labs.real_time_screen_gaze.gaze_mapper import GazeMapper
+from PySide6.QtCore import QThread, Signal
+
+from gaze_recording import GazeRecorder, discover_devices
+from gaze_synthetic import SyntheticGaze
+from marker_pool import MarkerPool, SurfaceSet, eyeOpen, readMapperResult
+from surface_tracking import SurfaceCache
+
+calibrationCacheDir = Path.home() / '.cache' / 'pupil-pointer' / 'calibrations'
+
+# Devices in use by a GazeWorker of this process, by deviceKey()
+claimedDevices = set()
+claimLock = threading.Lock()
+
+# What the gaze worker hands to the GUI: marker feedback plus (x, y, timestamp,
+# open) surface gaze samples, already mapped and in normalized surface
+# coordinates. open is 1.0, or 0.0 for samples taken during a blink or dropout.
+# receivedAt and publishedAt are time.monotonic() values taken when the data
+# came off the device and when it was handed over. Sample timestamps are in
+# device time; subtracting clockOffset aligns them with time.monotonic().
+MappedGaze = namedtuple('MappedGaze', ['markerIds', 'points', 'timestamp', 'receivedAt', 'publishedAt', 'clockOffset'])
+
+
+class LatestValue():
+    # Single-slot mailbox between two threads. The writer overwrites whatever
+    # the reader has not taken yet, so neither side ever blocks. deque.append
+    # and deque.popleft are atomic, which is all the synchronization we need.
+    #
+    # put() returns True when the reader has to be woken up. The reader clears
+    # the flag before taking, so a value put after that always wakes it again.
+    def __init__(self):
+        self.slot = deque(maxlen=1)
+        self.written = 0
+        self.dropped = 0
+        self.wakePending = False
+
+    def put(self, value):
+        if self.slot:
+            self.dropped += 1
+        self.slot.append(value)
+        self.written += 1
+
+        if self.wakePending:
+            return False
+        self.wakePending = True
+        return True
+
+    def take(self):
+        self.wakePending = False
+        try:
+            return self.slot.popleft()
+        except IndexError:
+            return None
+
+
+class LatencyStats():
+    # Rolling window of latencies in seconds
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+
+    def add(self, latency):
+        self.samples.append(latency)
+
+    def mean(self):
+        if not self.samples:
+            return 0.0
+        return float(np.mean(self.samples))
+
+    def percentile(self, q):
+        if not self.samples:
+            return 0.0
+        return float(np.percentile(self.samples, q))
+
+    def summary(self):
+        return f'{self.mean()*1000:.1f} ms mean, {self.percentile(99)*1000:.1f} ms p99'
+
+
+class LatencyBreakdown():
+    # Where the time between a gaze sample being captured and its effect goes:
+    #   network   capture on the device to arrival on the host
+    #   mapping   arrival to hand-over by the worker (marker detection, mapping)
+    #   handover  hand-over to handling on the GUI thread
+    #   dwell     smoothing and dwell detection of the batch
+    #   audio     dwell activation to note-on
+    #   display   cursor update to the end of the repaint
+    # plus the age of the newest sample when it is painted and when a note plays.
+    stages = ['network', 'mapping', 'handover', 'dwell', 'audio', 'display']
+    ages = ['paint', 'note-on']
+
+    def __init__(self):
+        self.stats = {name: LatencyStats() for name in self.stages + self.ages}
+
+    def add(self, name, latency):
+        self.stats[name].add(latency)
+
+    def format(self, name):
+        stats = self.stats[name]
+        if not stats.samples:
+            return f'{name} n/a'
+        return f'{name} {stats.mean()*1000:.1f}'
+
+    def summary(self):
+        stages = ', '.join(self.format(name) for name in self.stages)
+        ages = ', '.join(self.format(name) for name in self.ages)
+        return f'Latency by stage (ms mean): {stages}\nGaze age at (ms mean): {ages}'
+
+
+class ClockSync():
+    # Relates device timestamps (unix seconds on the phone's clock) to the
+    # host's time.monotonic(): device timestamp - offset() = host time.
+    #
+    # Devices that offer it are measured with the realtime API's time echo
+    # protocol every interval seconds. Otherwise the offset is estimated from
+    # the arrivals themselves: device timestamp - arrival time is the offset
+    # minus that sample's delay, so its maximum over a window of arrivals is
+    # the offset minus the smallest delay seen, which stays in the estimate.
+    #
+    # A time echo is a series of round trips to the phone, so it runs on a
+    # thread of its own rather than holding up gaze intake; until its first
+    # result the arrivals are used.
+    def __init__(self, interval=30.0, window=500, measurements=10):
+        self.interval = interval
+        self.measurements = measurements
+        self.arrivals = deque(maxlen=window)
+        self.generation = 0
+        self.measuring = None
+        self.reset()
+
+    def reset(self):
+        # Measurements still running for the previous device are discarded
+        self.generation += 1
+        self.arrivals.clear()
+        # (offset, round trip) of the last time echo, replaced as a whole
+        self.measurement = None
+        self.measuredAt = None
+        self.measurable = True
+
+    def due(self):
+        if not self.measurable:
+            return False
+        return self.measuredAt is None or time.monotonic() - self.measuredAt > self.interval
+
+    def measure(self, device):
+        if getattr(device, 'estimate_time_offset', None) is None:
+            self.measurable = False
+            return
+        if self.measuring is not None and self.measuring.is_alive():
+            return
+
+        self.measuredAt = time.monotonic()
+        self.measuring = threading.Thread(target=self.echo, args=(device, self.generation), daemon=True)
+        self.measuring.start()
+
+    def echo(self, device, generation):
+        try:
+            estimates = device.estimate_time_offset(number_of_measurements=self.measurements)
+        except Exception as e:
+            print(f'Could not measure the clock offset of {device}: {e}')
+            return
+        if estimates is None or generation != self.generation:
+            return
+
+        # The API reports device clock - host clock, both unix time, in ms
+        unixToMonotonic = time.time() - time.monotonic()
+        self.measurement = (
+            estimates.time_offset_ms.mean/1000 + unixToMonotonic,
+            estimates.roundtrip_duration_ms.mean/1000,
+        )
+
+    def observe(self, deviceTimestamp, receivedAt):
+        self.arrivals.append(deviceTimestamp - receivedAt)
+
+    def offset(self):
+        measurement = self.measurement
+        if measurement is not None:
+            return measurement[0]
+        if self.arrivals:
+            return max(self.arrivals)
+        return time.time() - time.monotonic()
+
+
+def deviceKey(device):
+    # Every discovery opens a new connection, so two connections to one phone
+    # are told apart by what the phone reports, not by the connection object
+    phoneId = getattr(device, 'phone_id', None)
+    if phoneId:
+        return phoneId
+    if getattr(device, 'address', None) is not None:
+        return (device.address, device.port)
+    return repr(device)
+
+
+# Serial numbers the realtime API reports when it has no real one
+placeholderSerials = {None, '', 'default', '-1'}
+
+
+def loadCalibration(device):
+    # Calibrations only change with the glasses, so they are cached on disk per
+    # serial number and reconnects skip fetching them from the phone again. On
+    # Neon the calibration belongs to the swappable module, not to the frame.
+    serial = getattr(device, 'module_serial', None)
+    if serial in placeholderSerials:
+        serial = device.serial_number_glasses
+    if serial in placeholderSerials:
+        return device.get_calibration()
+
+    path = calibrationCacheDir / f'{serial}.npy'
+    if path.exists():
+        return np.load(path)
+
+    calibration = device.get_calibration()
+    calibrationCacheDir.mkdir(parents=True, exist_ok=True)
+    np.save(path, calibration)
+    return calibration
+
+
+class GazeWorker(QThread):
+    # Owns the device and the GazeMapper so that the blocking receive and the
+    # marker detection never run on the GUI thread. With markerProcesses > 0
+    # the detection moves on to a MarkerPool of worker processes instead, with
+    # detectionInterval > 1 a SurfaceCache skips detection on stable frames.
+    # With adaptiveDetection the SurfaceCache finds the markers itself, on
+    # grayscale frames downscaled as far as detection allows.
+    #
+    # With fullRate the gaze stream is consumed on its own at up to 200 Hz and
+    # every sample is mapped through the latest SurfaceCache homography. Scene
+    # frames are then only used, on a second thread, to refresh that homography;
+    # the GazeMapper only runs on every errorInterval-th of them, for the
+    # cached mapping error.
+    #
+    # gazeAvailable is emitted when new mapped gaze is waiting in output and
+    # the GUI has not been told yet; it is never emitted while no data arrives.
+    #
+    # Scene frames follow a latest-frame-wins policy: only the newest one is
+    # ever mapped, older ones are dropped and counted, so latency stays bounded
+    # when mapping falls behind.
+    #
+    # Discovery retries with exponential backoff, and a connection that stops
+    # delivering data for stallTimeout seconds is closed and discovered again.
+    # Several workers can run side by side, one per participant; each claims
+    # a device that no other worker is using.
+    statusChanged = Signal(str)
+    gazeAvailable = Signal()
+
+    maxBatch = 256
+    errorInterval = 30
+    minBackoff = 0.5
+    maxBackoff = 8.0
+    stallTimeout = 3.0
+
+    def __init__(self, markerProcesses=0, detectionInterval=1, searchRois=False, fullRate=False, recordTo=None, adaptiveDetection=False):
+        super().__init__()
+
+        self.device = None
+        self.gazeMapper = None
+        self.surfaces = None
+        self.surface = None
+        self.running = False
+
+        self.markerProcesses = 0 if fullRate else markerProcesses
+        self.markerPool = None
+        self.detectionInterval = detectionInterval
+        self.searchRois = searchRois
+        self.adaptiveDetection = adaptiveDetection
+        self.surfaceCache = None
+        self.fullRate = fullRate
+        self.latestGaze = None
+        self.lastTimestamp = None
+        self.lastDataAt = 0
+        self.streaming = False
+        self.framesReceived = 0
+        self.framesDropped = 0
+
+        self.recordTo = recordTo
+        self.recorder = None
+        self.clockSync = ClockSync()
+
+        self.surfaceDefinition = None
+        self.pendingSurface = LatestValue()
+        self.output = LatestValue()
+
+    def setSurface(self, markerVerts, surfaceSize, key):
+        # Called from the GUI thread, applied by the worker between frames.
+        # key identifies the definition (window and tag size) for SurfaceSet.
+        self.pendingSurface.put((markerVerts, surfaceSize, key))
+
+    def start(self):
+        self.running = True
+        super().start()
+
+    def stop(self):
+        self.running = False
+        self.wait()
+
+    def run(self):
+        if self.recordTo is not None:
+            self.recorder = GazeRecorder(self.recordTo)
+
+        try:
+            self.runDevices()
+        finally:
+            if self.recorder is not None:
+                self.recorder.close()
+
+    def runDevices(self):
+        backoff = self.minBackoff
+        while self.running:
+            self.device = self.claimDevice()
+            if self.device is None:
+                self.idle(backoff)
+                backoff = min(backoff*2, self.maxBackoff)
+                continue
+
+            backoff = self.minBackoff
+            try:
+                self.prepareDevice()
+                if self.fullRate:
+                    self.streamFullRate()
+                else:
+                    self.streamMatched()
+
+            except Exception as e:
+                print(f'Lost connection to {self.device}: {e}')
+
+            finally:
+                self.releaseDevice()
+
+            if self.running:
+                self.statusChanged.emit('Reconnecting...')
+
+    def claimDevice(self):
+        claimed = None
+        for device in discover_devices(search_duration_seconds=0.25):
+            with claimLock:
+                if claimed is None and deviceKey(device) not in claimedDevices:
+                    claimedDevices.add(deviceKey(device))
+                    claimed = device
+                    continue
+            device.close()
+
+        return claimed
+
+    def idle(self, seconds):
+        # Sleep in short steps so that stop() does not have to wait for it
+        until = time.monotonic() + seconds
+        while self.running and time.monotonic() < until:
+            self.msleep(100)
+
+    def prepareDevice(self):
+        calibration = loadCalibration(self.device)
+        if self.recorder is not None:
+            self.recorder.setCalibration(calibration)
+
+        if self.markerProcesses > 0:
+            self.markerPool = MarkerPool(self.markerProcesses, onResult=self.publish)
+            self.markerPool.start(calibration)
+        else:
+            self.gazeMapper = GazeMapper(calibration)
+            self.surfaces = SurfaceSet(self.gazeMapper)
+            if self.detectionInterval > 1 or self.fullRate or self.adaptiveDetection:
+                self.surfaceCache = SurfaceCache(
+                    self.gazeMapper, calibration, self.detectionInterval,
+                    searchRois=self.searchRois, adaptive=self.adaptiveDetection,
+                    mapperInterval=self.errorInterval if self.fullRate else 1,
+                )
+
+        # A new mapper starts without surfaces; hand it the current one again
+        if self.surfaceDefinition is not None and not self.pendingSurface.slot:
+            self.pendingSurface.put(self.surfaceDefinition)
+
+        self.clockSync.reset()
+        self.clockSync.measure(self.device)
+
+        self.lastDataAt = time.monotonic()
+        self.statusChanged.emit(f'Connected to {self.device}. One moment...')
+
+    def releaseDevice(self):
+        if self.markerPool is not None:
+            self.markerPool.close()
+            self.framesDropped += self.markerPool.framesDropped
+            self.markerPool = None
+
+        self.gazeMapper = None
+        self.surfaces = None
+        self.surfaceCache = None
+        self.surface = None
+        self.latestGaze = None
+        self.lastTimestamp = None
+
+        try:
+            self.device.close()
+        except Exception as e:
+            print(f'Error closing {self.device}: {e}')
+
+        with claimLock:
+            claimedDevices.discard(deviceKey(self.device))
+        self.device = None
+
+    def stalled(self):
+        # Watchdog for a connection that is up but no longer delivers data
+        if time.monotonic() - self.lastDataAt < self.stallTimeout:
+            return False
+
+        self.statusChanged.emit(f'No data from {self.device} for {self.stallTimeout} s')
+        return True
+
+    def receiveLatest(self, receive):
+        # Latest frame wins: whatever queued up behind the newest frame while we
+        # were busy is stale, so it is skipped (and counted) instead of mapped
+        data = receive(timeout_seconds=1/15)
+        if data is None:
+            return None
+
+        self.framesReceived += 1
+        while True:
+            newer = receive(timeout_seconds=0)
+            if newer is None:
+                return data
+
+            self.framesReceived += 1
+            self.framesDropped += 1
+            data = newer
+
+    def droppedFrames(self):
+        # Stale frames skipped at the device plus frames replaced in the pool
+        dropped = self.framesDropped
+        if self.markerPool is not None:
+            dropped += self.markerPool.framesDropped
+        return dropped
+
+    def streamMatched(self):
+        firstFrame = True
+        while self.running:
+            self.applyPendingSurface()
+
+            frameAndGaze = self.receiveLatest(self.device.receive_matched_scene_video_frame_and_gaze)
+            if frameAndGaze is None:
+                if self.stalled():
+                    return
+                continue
+
+            receivedAt = time.monotonic()
+            self.lastDataAt = receivedAt
+            self.clockSync.observe(frameAndGaze[1].timestamp_unix_seconds, receivedAt)
+            if self.recorder is not None:
+                self.recorder.recordMatched(*frameAndGaze)
+
+            if self.clockSync.due():
+                self.clockSync.measure(self.device)
+
+            if firstFrame:
+                self.statusChanged.emit(f'Streaming data from {self.device}')
+                firstFrame = False
+
+            self.processFrame(*frameAndGaze, receivedAt)
+
+    def streamFullRate(self):
+        self.streaming = True
+        frameThread = threading.Thread(target=self.refreshHomography, daemon=True)
+        frameThread.start()
+
+        firstSample = True
+        try:
+            while self.running:
+                gaze = self.device.receive_gaze_datum(timeout_seconds=1/15)
+                if gaze is None:
+                    if self.stalled():
+                        return
+                    continue
+
+                receivedAt = time.monotonic()
+                self.lastDataAt = receivedAt
+                self.latestGaze = gaze
+                self.clockSync.observe(gaze.timestamp_unix_seconds, receivedAt)
+                if self.recorder is not None:
+                    self.recorder.recordGaze(gaze)
+
+                if self.clockSync.due():
+                    self.clockSync.measure(self.device)
+
+                point = self.surfaceCache.mapGaze(gaze.x, gaze.y)
+                if point is None:
+                    continue
+
+                if firstSample:
+                    self.statusChanged.emit(f'Streaming full-rate gaze from {self.device}')
+                    firstSample = False
+
+                sample = (*point, gaze.timestamp_unix_seconds, float(eyeOpen(gaze)))
+                self.publishSamples(self.surfaceCache.markerIds, [sample], receivedAt)
+
+        finally:
+            self.streaming = False
+            frameThread.join()
+
+    def refreshHomography(self):
+        # Scene frame thread of the full-rate mode. It is the only user of the
+        # GazeMapper, so surface changes are applied here as well.
+        while self.streaming:
+            self.applyPendingSurface()
+
+            frame = self.receiveLatest(self.device.receive_scene_video_frame)
+            if frame is None or self.latestGaze is None:
+                continue
+
+            if self.recorder is not None:
+                self.recorder.recordFrame(frame)
+
+            self.surfaceCache.process_frame(frame, self.latestGaze)
+
+    def applyPendingSurface(self):
+        surfaceDefinition = self.pendingSurface.take()
+        if surfaceDefinition is None:
+            return
+
+        self.surfaceDefinition = surfaceDefinition
+        if self.markerPool is not None:
+            self.markerPool.setSurface(*surfaceDefinition)
+            return
+
+        if self.surfaceCache is not None:
+            self.surfaceCache.setSurface(*surfaceDefinition)
+            return
+
+        self.surface = self.surfaces.activate(*surfaceDefinition)
+
+    def processFrame(self, frame, gaze, receivedAt):
+        if self.markerPool is not None:
+            self.markerPool.submit(frame, gaze, receivedAt)
+            return
+
+        if self.surfaceCache is not None:
+            markerIds, points = self.surfaceCache.process_frame(frame, gaze)
+        else:
+            markerIds, points = readMapperResult(self.gazeMapper.process_frame(frame, gaze), self.surface)
+
+        self.publish(markerIds, points, gaze.timestamp_unix_seconds, receivedAt, eyeOpen(gaze))
+
+    def publish(self, markerIds, points, timestamp, receivedAt, isOpen=True):
+        # Pool workers can finish out of order; never publish older gaze
+        if self.lastTimestamp is not None and timestamp < self.lastTimestamp:
+            return
+
+        self.lastTimestamp = timestamp
+        samples = [(x, y, timestamp, float(isOpen)) for x, y in points]
+        self.handOver(MappedGaze(markerIds, samples, timestamp, receivedAt, time.monotonic(), self.clockSync.offset()))
+
+    def publishSamples(self, markerIds, samples, receivedAt):
+        # Full-rate samples must not be lost to the latest-value slot, so the
+        # ones the GUI has not taken yet are carried over into the new batch.
+        # timestamp stays that of the newest sample when receivedAt was taken.
+        # Beyond maxBatch the oldest samples are dropped, and counted as such.
+        publishedAt = time.monotonic()
+        timestamp = samples[-1][2]
+        pending = self.output.take()
+        if pending is not None:
+            samples = pending.points + samples
+            timestamp = pending.timestamp
+            receivedAt = pending.receivedAt
+            publishedAt = pending.publishedAt
+        if len(samples) > self.maxBatch:
+            self.output.dropped += len(samples) - self.maxBatch
+            samples = samples[-self.maxBatch:]
+
+        self.handOver(MappedGaze(markerIds, samples, timestamp, receivedAt, publishedAt, self.clockSync.offset()))
+
+    def handOver(self, mappedGaze):
+        if self.output.put(mappedGaze):
+            self.gazeAvailable.emit()
+
+
+class SyntheticGazeWorker(GazeWorker):
+    # Stands in for GazeWorker without any glasses: SyntheticGaze samples are
+    # handed to the GUI in real time at the given rate, through the same
+    # output slot and gazeAvailable signal as mapped device gaze.
+    markerIds = [0, 1, 2, 3]
+
+    def __init__(self, rate=200, **options):
+        super().__init__()
+        self.gaze = SyntheticGaze(rate, **options)
+        self.pendingTargets = None
+
+    def setTargets(self, targets):
+        # Called from the GUI thread with normalized surface positions
+        self.pendingTargets = targets
+
+    def run(self):
+        self.statusChanged.emit(f'Streaming synthetic gaze at {self.gaze.rate:g} Hz')
+        self.gaze.start(time.time())
+        interval = max(1, int(1000/self.gaze.rate))
+
+        while self.running:
+            self.msleep(interval)
+
+            targets, self.pendingTargets = self.pendingTargets, None
+            if targets:
+                self.gaze.setTargets(targets)
+
+            samples, _ = self.gaze.generate(time.time())
+            if len(samples) == 0:
+                continue
+
+            receivedAt = time.monotonic()
+            self.lastDataAt = receivedAt
+            self.clockSync.observe(samples[-1, 2], receivedAt)
+            self.framesReceived += len(samples)
+            # Blinks are gaps in the synthetic stream, every sample is open
+            samples = np.column_stack([samples, np.ones(len(samples))])
+            self.publishSamples(self.markerIds, samples.tolist(), receivedAt)
+
+
+def syntheticRate():
+    # PUPIL_SYNTHETIC=<rate in Hz> makes the interfaces use synthetic gaze
+    return float(os.environ.get('PUPIL_SYNTHETIC', 0))
@@ -0,0 +1,281 @@
+import json
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+import numpy as np
+from pupil_labs.realtime_api.simple import discover_devices as discoverRealDevices
+from pupil_labs.realtime_api.simple import discover_one_device as discoverRealDevice
+
+from marker_pool import SceneFrame
+
+# A recording is a directory holding
+#   calibration.npy  the device calibration
+#   events.jsonl     one line per received item, in arrival order
+#   frames.bin       the raw BGR pixels of every scene frame, back to back
+# Event lines have a "kind" of "matched", "gaze" or "frame". Gaze is stored
+# with all the fields the device sent, frames as an offset into frames.bin.
+#
+# Like real glasses, a replayed recording keeps going when the gaze worker
+# reconnects: discovery hands out the same ReplayDevice again. It plays once,
+# afterwards discovery no longer finds it, so nothing starts over with device
+# timestamps going back in time. PUPIL_REPLAY_LOOP=1 plays it again and again
+# instead, every pass shifted in time to follow the previous one after
+# loopGap seconds.
+
+loopGap = 1.0
+# Path -> ReplayDevice of the recordings replayed so far
+replayDevices = {}
+# Paths of the recordings that were played to the end
+finishedReplays = set()
+
+
+def gazeToDict(gaze):
+    # Device fields can be NumPy scalars, which json cannot write
+    return {key: value.item() if hasattr(value, 'item') else value for key, value in gaze._asdict().items()}
+
+
+class GazeData():
+    # Replayed gaze, with whatever fields the device sent as attributes. A
+    # plain class, unlike a namedtuple made per recording, can be pickled
+    # into the marker processes.
+    def __init__(self, fields):
+        self.__dict__.update(fields)
+
+    def _asdict(self):
+        return dict(self.__dict__)
+
+
+class GazeRecorder():
+    # Writes what the gaze worker receives to disk on a background thread. The
+    # queue is bounded so a slow disk costs recorded items, never gaze latency.
+    # The bound is in bytes, as a raw scene frame weighs thousands of gaze
+    # samples: at 1600x1200 the default holds about 11 frames.
+    eventBytes = 256 # roughly what one event takes in the queue without pixels
+
+    def __init__(self, path, maxQueueBytes=64*1024*1024):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+
+        self.queue = queue.Queue()
+        self.maxQueueBytes = maxQueueBytes
+        self.queuedBytes = 0
+        self.queueLock = threading.Lock()
+        self.recorded = 0
+        # A matched item that does not fit counts as a dropped frame
+        self.framesDropped = 0
+        self.gazeDropped = 0
+
+        self.writer = threading.Thread(target=self.write, daemon=True)
+        self.writer.start()
+
+    def setCalibration(self, calibration):
+        np.save(self.path / 'calibration.npy', calibration)
+
+    def recordMatched(self, frame, gaze):
+        self.enqueue({'kind': 'matched', 'gaze': gazeToDict(gaze)}, frame)
+
+    def recordGaze(self, gaze):
+        self.enqueue({'kind': 'gaze', 'gaze': gazeToDict(gaze)}, None)
+
+    def recordFrame(self, frame):
+        self.enqueue({'kind': 'frame'}, frame)
+
+    def enqueue(self, event, frame):
+        event['receivedAt'] = time.time()
+        if frame is not None:
+            event['frameTimestamp'] = frame.timestamp_unix_seconds
+            frame = frame.bgr_pixels
+
+        size = self.eventBytes + (frame.nbytes if frame is not None else 0)
+        with self.queueLock:
+            if self.queuedBytes + size > self.maxQueueBytes:
+                if frame is None:
+                    self.gazeDropped += 1
+                else:
+                    self.framesDropped += 1
+                return
+            self.queuedBytes += size
+
+        self.queue.put((event, frame, size))
+        self.recorded += 1
+
+    def write(self):
+        with open(self.path / 'events.jsonl', 'w') as events, open(self.path / 'frames.bin', 'wb') as frames:
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+
+                event, pixels, size = item
+                if pixels is not None:
+                    event['frameOffset'] = frames.tell()
+                    event['frameShape'] = list(pixels.shape)
+                    frames.write(np.ascontiguousarray(pixels, dtype=np.uint8).tobytes())
+
+                events.write(json.dumps(event) + '\n')
+                with self.queueLock:
+                    self.queuedBytes -= size
+
+    def close(self):
+        self.queue.put(None)
+        self.writer.join()
+        if self.framesDropped or self.gazeDropped:
+            print(f'Recording to {self.path} dropped {self.framesDropped} scene frames and {self.gazeDropped} gaze samples')
+
+
+class ReplayDevice():
+    # Plays a recording back through the parts of the simple realtime API
+    # device that the interfaces use. With realtime=True items are released at
+    # their recorded pace, otherwise as fast as they are asked for. Original
+    # device timestamps are kept, so replays are reproducible.
+    serial_number_glasses = None
+
+    def __init__(self, path, realtime=True, loop=False):
+        self.path = Path(path)
+        self.realtime = realtime
+        self.loop = loop
+        self.calibration = np.load(self.path / 'calibration.npy')
+
+        framesPath = self.path / 'frames.bin'
+        self.frames = None
+        if framesPath.stat().st_size > 0:
+            self.frames = np.memmap(framesPath, dtype=np.uint8, mode='r')
+
+        self.streams = {'matched': [], 'gaze': [], 'frame': []}
+        with open(self.path / 'events.jsonl') as events:
+            for line in events:
+                event = json.loads(line)
+                self.streams[event['kind']].append(event)
+
+        # Matched gaze also feeds the gaze stream when no raw gaze was recorded
+        if not self.streams['gaze']:
+            self.streams['gaze'] = list(self.streams['matched'])
+        if not self.streams['frame']:
+            self.streams['frame'] = list(self.streams['matched'])
+
+        self.positions = {kind: 0 for kind in self.streams}
+        self.passes = {kind: 0 for kind in self.streams}
+        firstTimes = [stream[0]['receivedAt'] for stream in self.streams.values() if stream]
+        lastTimes = [stream[-1]['receivedAt'] for stream in self.streams.values() if stream]
+        self.recordingStart = min(firstTimes) if firstTimes else 0
+        # How far every loop shifts arrival and device times
+        self.period = (max(lastTimes) - self.recordingStart if lastTimes else 0) + loopGap
+        deviceTimes = [
+            timestamp for stream in self.streams.values() for event in stream
+            for timestamp in (event.get('frameTimestamp'), event.get('gaze', {}).get('timestamp_unix_seconds'))
+            if timestamp is not None
+        ]
+        self.devicePeriod = (max(deviceTimes) - min(deviceTimes) if deviceTimes else 0) + loopGap
+        self.replayStart = time.monotonic()
+
+    def __str__(self):
+        return f'Replay of {self.path}'
+
+    def __repr__(self):
+        return f'ReplayDevice({str(self.path)!r})'
+
+    def get_calibration(self):
+        return self.calibration
+
+    def close(self):
+        # The recording stays open for the next connection
+        pass
+
+    def receive_matched_scene_video_frame_and_gaze(self, timeout_seconds=None):
+        event = self.next('matched', timeout_seconds)
+        if event is None:
+            return None
+        return self.toFrame(event), self.toGaze(event['gaze'])
+
+    def receive_gaze_datum(self, timeout_seconds=None):
+        event = self.next('gaze', timeout_seconds)
+        if event is None:
+            return None
+        return self.toGaze(event['gaze'])
+
+    def receive_scene_video_frame(self, timeout_seconds=None):
+        event = self.next('frame', timeout_seconds)
+        if event is None:
+            return None
+        return self.toFrame(event)
+
+    def next(self, kind, timeout_seconds):
+        stream = self.streams[kind]
+        position = self.positions[kind]
+        # A receive that does not wait only drains what is left of this pass
+        if position >= len(stream) and self.loop and stream and timeout_seconds != 0:
+            self.passes[kind] += 1
+            self.positions[kind] = position = 0
+        if position >= len(stream):
+            if not self.loop:
+                finishedReplays.add(str(self.path))
+            if timeout_seconds:
+                time.sleep(timeout_seconds)
+            return None
+
+        event = stream[position]
+        if self.passes[kind]:
+            event = self.shifted(event, self.passes[kind])
+        if self.realtime:
+            wait = (event['receivedAt'] - self.recordingStart) - (time.monotonic() - self.replayStart)
+            if timeout_seconds is not None and wait > timeout_seconds:
+                time.sleep(timeout_seconds)
+                return None
+            if wait > 0:
+                time.sleep(wait)
+
+        self.positions[kind] = position + 1
+        return event
+
+    def shifted(self, event, passes):
+        event = dict(event, receivedAt=event['receivedAt'] + passes*self.period)
+        shift = passes*self.devicePeriod
+        if 'frameTimestamp' in event:
+            event['frameTimestamp'] += shift
+        if 'gaze' in event:
+            gaze = event['gaze']
+            event['gaze'] = dict(gaze, timestamp_unix_seconds=gaze['timestamp_unix_seconds'] + shift)
+        return event
+
+    def toFrame(self, event):
+        size = int(np.prod(event['frameShape']))
+        offset = event['frameOffset']
+        pixels = self.frames[offset:offset + size].reshape(event['frameShape'])
+        return SceneFrame(pixels, event['frameTimestamp'])
+
+    def toGaze(self, fields):
+        return GazeData(fields)
+
+
+def discover_one_device(max_search_duration_seconds=10.0):
+    # Drop-in for the realtime API function. With PUPIL_REPLAY set to a
+    # recording directory that recording is replayed instead of searching the
+    # network; PUPIL_REPLAY_FAST=1 replays it as fast as possible.
+    replayPath = os.environ.get('PUPIL_REPLAY')
+    if replayPath:
+        devices = discover_devices()
+        return devices[0] if devices else None
+
+    return discoverRealDevice(max_search_duration_seconds=max_search_duration_seconds)
+
+
+def discover_devices(search_duration_seconds=10.0):
+    # Same for every device on the network. PUPIL_REPLAY may list several
+    # recordings, separated like PATH entries, one per simulated device.
+    replayPaths = os.environ.get('PUPIL_REPLAY')
+    if replayPaths:
+        realtime = os.environ.get('PUPIL_REPLAY_FAST') != '1'
+        loop = os.environ.get('PUPIL_REPLAY_LOOP') == '1'
+        devices = []
+        for path in replayPaths.split(os.pathsep):
+            if not path or str(Path(path)) in finishedReplays:
+                continue
+            if path not in replayDevices:
+                replayDevices[path] = ReplayDevice(path, realtime=realtime, loop=loop)
+            devices.append(replayDevices[path])
+        return devices
+
+    return discoverRealDevices(search_duration_seconds=search_duration_seconds)
@@ -0,0 +1,104 @@
+import numpy as np
+
+
+class SyntheticGaze():
+    # Generates surface gaze (normalized, origin bottom left) that visits a
+    # list of targets one after the other. Each visit is a saccade, or now and
+    # then a smooth pursuit, to the target followed by a fixation on it. Blinks
+    # interrupt fixations and leave gaps without samples. Gaussian jitter with
+    # a standard deviation of jitter surface units is added to every sample.
+    #
+    # Samples come out in batches of everything due up to a given time, each
+    # labelled with the movement it belongs to, so the labels can serve as
+    # ground truth for the classifiers downstream.
+    def __init__(self, rate=200, targets=((0.5, 0.5),), fixationDuration=1.0, jitter=0.003,
+                 pursuitProbability=0.2, pursuitSpeed=0.3, blinkProbability=0.2, blinkDuration=0.15, seed=None):
+        self.rate = rate
+        self.targets = [tuple(target) for target in targets]
+        self.fixationDuration = fixationDuration
+        self.jitter = jitter
+        self.pursuitProbability = pursuitProbability
+        self.pursuitSpeed = pursuitSpeed
+        self.blinkProbability = blinkProbability
+        self.blinkDuration = blinkDuration
+        self.random = np.random.default_rng(seed)
+
+        self.position = np.array(self.targets[0], dtype=np.float64)
+        self.targetIndex = 0
+        self.segments = []
+        self.startTime = None
+        self.sampleIndex = 0
+
+    def setTargets(self, targets):
+        # Takes effect with the next movement; the current one is finished
+        self.targets = [tuple(target) for target in targets]
+        self.targetIndex = 0
+
+    def start(self, startTime):
+        self.startTime = startTime
+        self.sampleIndex = 0
+        self.segments = [('fixation', startTime, startTime + self.fixationDuration, self.position, self.position)]
+
+    def nextTarget(self):
+        self.targetIndex = (self.targetIndex + 1) % len(self.targets)
+        return np.array(self.targets[self.targetIndex], dtype=np.float64)
+
+    def planSegments(self):
+        # Append the movements that follow the last planned segment
+        kind, _, end, _, position = self.segments[-1]
+
+        if kind == 'fixation' and self.random.random() < self.blinkProbability:
+            # A blink, then the eye settles back on the same spot
+            self.segments.append(('blink', end, end + self.blinkDuration, position, position))
+            end += self.blinkDuration
+            self.segments.append(('fixation', end, end + self.fixationDuration/2, position, position))
+            return
+
+        target = self.nextTarget()
+        distance = np.hypot(*(target - position))
+        if self.random.random() < self.pursuitProbability:
+            movement = ('pursuit', end, end + distance/self.pursuitSpeed, position, target)
+        else:
+            # Main sequence: saccades last about 20 ms plus a little per unit of amplitude
+            movement = ('saccade', end, end + 0.02 + 0.1*distance, position, target)
+
+        end = movement[2]
+        self.segments.append(movement)
+        self.segments.append(('fixation', end, end + self.fixationDuration, target, target))
+
+    def generate(self, until):
+        # Returns an (N, 3) array of (x, y, timestamp) samples and their N labels
+        count = int((until - self.startTime)*self.rate) + 1 - self.sampleIndex
+        if count <= 0:
+            return np.empty((0, 3)), np.empty(0, dtype='<U8')
+
+        timestamps = self.startTime + (self.sampleIndex + np.arange(count))/self.rate
+        self.sampleIndex += count
+        while self.segments[-1][2] <= timestamps[-1]:
+            self.planSegments()
+
+        points = np.empty((count, 2))
+        labels = np.empty(count, dtype='<U8')
+        keep = np.ones(count, dtype=bool)
+
+        for kind, start, end, origin, target in self.segments:
+            inSegment = (timestamps >= start) & (timestamps < end)
+            if not inSegment.any():
+                continue
+
+            progress = (timestamps[inSegment] - start)/(end - start)
+            if kind == 'saccade':
+                # Smooth start and stop, peak velocity halfway
+                progress = progress*progress*(3 - 2*progress)
+            points[inSegment] = origin + progress[:, None]*(target - origin)
+            labels[inSegment] = kind
+            if kind == 'blink':
+                keep[inSegment] = False
+
+        # Only the segment still in progress matters for the next batch
+        while len(self.segments) > 1 and self.segments[0][2] <= timestamps[-1]:
+            self.segments.pop(0)
+
+        points += self.random.normal(0.0, self.jitter, points.shape)
+        samples = np.column_stack([points, timestamps])
+        return samples[keep], labels[keep]
@@ -0,0 +1,247 @@
+import multiprocessing
+import threading
+from collections import OrderedDict, deque, namedtuple
+from multiprocessing import shared_memory
+
+import numpy as np
+from pupil_labs.real_time_screen_gaze.gaze_mapper import GazeMapper
+
+# Stand-in for the realtime API's SceneVideoFrame, rebuilt on the worker side
+# around a view into shared memory. GazeMapper only reads the pixels.
+SceneFrame = namedtuple('SceneFrame', ['bgr_pixels', 'timestamp_unix_seconds'])
+
+
+def readMapperResult(result, surface):
+    # Reduce a GazeMapper result to what the GUI needs
+    markerIds = [int(marker.uid.split(':')[-1]) for marker in result.markers]
+    points = []
+    if surface is not None and surface.uid in result.mapped_gaze:
+        points = [(surface_gaze.x, surface_gaze.y) for surface_gaze in result.mapped_gaze[surface.uid]]
+
+    return markerIds, points
+
+
+def eyeOpen(gaze, minEyelidAperture=1.0, minConfidence=0.6):
+    # Whether a gaze sample can be trusted, from whatever the device reports:
+    # glasses worn (Pupil Invisible, Neon), eyelid aperture in mm (Neon eye
+    # state) or confidence. Samples during blinks and dropouts fail this.
+    if getattr(gaze, 'worn', True) is False:
+        return False
+
+    apertures = [getattr(gaze, name, None) for name in ('eyelid_aperture_left', 'eyelid_aperture_right')]
+    apertures = [aperture for aperture in apertures if aperture is not None]
+    if apertures and max(apertures) < minEyelidAperture:
+        return False
+
+    confidence = getattr(gaze, 'confidence', None)
+    return confidence is None or confidence >= minConfidence
+
+
+class SurfaceSet():
+    # Keeps the surfaces of the last few window and tag sizes registered with
+    # a GazeMapper, so switching back to one of them (toggling fullscreen, say)
+    # needs no rebuild. Every registered surface gets gaze mapped onto it, so
+    # the set is kept small.
+    def __init__(self, gazeMapper, size=2):
+        self.gazeMapper = gazeMapper
+        self.size = size
+        self.surfaces = OrderedDict()
+
+    def activate(self, markerVerts, surfaceSize, key):
+        if key in self.surfaces:
+            self.surfaces.move_to_end(key)
+            return self.surfaces[key][0]
+
+        if len(self.surfaces) >= self.size:
+            self.surfaces.popitem(last=False)
+            self.gazeMapper.clear_surfaces()
+            for cachedKey, (_, definition) in self.surfaces.items():
+                self.surfaces[cachedKey] = (self.gazeMapper.add_surface(*definition), definition)
+
+        surface = self.gazeMapper.add_surface(markerVerts, surfaceSize)
+        self.surfaces[key] = (surface, (markerVerts, surfaceSize))
+        return surface
+
+
+class FrameRing():
+    # Fixed number of frame-sized slots in one shared memory block
+    def __init__(self, slots, shape, dtype=np.uint8, name=None):
+        self.slots = slots
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        frameBytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        if name is None:
+            self.memory = shared_memory.SharedMemory(create=True, size=slots*frameBytes)
+            self.owner = True
+        else:
+            self.memory = shared_memory.SharedMemory(name=name)
+            # Spawned workers share the parent's resource tracker, so attaching
+            # here does not hand ownership of the block to this process
+            self.owner = False
+
+        self.frames = np.ndarray((slots,) + self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    @property
+    def name(self):
+        return self.memory.name
+
+    def write(self, slot, pixels):
+        np.copyto(self.frames[slot], pixels)
+
+    def read(self, slot):
+        return self.frames[slot]
+
+    def close(self):
+        del self.frames
+        self.memory.close()
+        if self.owner:
+            self.memory.unlink()
+
+
+def detectMarkers(workerIndex, jobs, results):
+    # Worker process main loop. Jobs are tuples whose first entry names the kind.
+    gazeMapper = None
+    surfaces = None
+    surface = None
+    ring = None
+
+    while True:
+        job = jobs.get()
+        kind = job[0]
+
+        if kind == 'stop':
+            break
+
+        elif kind == 'calibration':
+            gazeMapper = GazeMapper(job[1])
+            surfaces = SurfaceSet(gazeMapper)
+            surface = None
+
+        elif kind == 'surface':
+            surface = surfaces.activate(*job[1:])
+
+        elif kind == 'ring':
+            if ring is not None:
+                ring.close()
+            ring = FrameRing(job[2], job[3], name=job[1])
+
+        elif kind == 'frame':
+            _, slot, frameTimestamp, gaze, receivedAt = job
+            frame = SceneFrame(ring.read(slot), frameTimestamp)
+            result = gazeMapper.process_frame(frame, gaze)
+            markerIds, points = readMapperResult(result, surface)
+            results.put((workerIndex, slot, markerIds, points, gaze.timestamp_unix_seconds, receivedAt, eyeOpen(gaze)))
+
+    if ring is not None:
+        ring.close()
+
+
+class MarkerPool():
+    # Runs GazeMapper.process_frame in worker processes. Scene frames travel
+    # through a shared memory ring, so only slot indices, gaze and the mapped
+    # results are pickled. Each process has at most one frame in flight and at
+    # most one more frame waits for the next free process.
+    def __init__(self, processes=2, onResult=None):
+        self.processes = processes
+        self.onResult = onResult
+
+        # spawn rather than fork: the parent runs Qt and capture threads
+        self.context = multiprocessing.get_context('spawn')
+        self.jobs = []
+        self.results = self.context.Queue()
+        self.workers = []
+
+        self.ring = None
+        self.freeSlots = deque()
+        self.idleWorkers = deque()
+        self.pending = None
+        self.framesDropped = 0
+        self.lock = threading.Lock()
+        self.collector = None
+
+    def start(self, calibration):
+        for workerIndex in range(self.processes):
+            jobs = self.context.Queue()
+            worker = self.context.Process(target=detectMarkers, args=(workerIndex, jobs, self.results), daemon=True)
+            worker.start()
+            jobs.put(('calibration', calibration))
+
+            self.jobs.append(jobs)
+            self.workers.append(worker)
+            self.idleWorkers.append(workerIndex)
+
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def setSurface(self, markerVerts, surfaceSize, key):
+        for jobs in self.jobs:
+            jobs.put(('surface', markerVerts, surfaceSize, key))
+
+    @property
+    def inFlight(self):
+        return self.processes - len(self.idleWorkers)
+
+    def submit(self, frame, gaze, receivedAt):
+        # Latest frame wins: while every worker is busy the frame waits as the
+        # pending one, replacing (and dropping) any older pending frame
+        pixels = frame.bgr_pixels
+
+        with self.lock:
+            reshape = self.ring is None or self.ring.shape != pixels.shape
+            if not self.idleWorkers or (reshape and self.inFlight):
+                if self.pending is not None:
+                    self.framesDropped += 1
+                self.pending = (frame, gaze, receivedAt)
+                return
+
+            if reshape:
+                self.allocateRing(pixels.shape)
+
+            workerIndex = self.idleWorkers.popleft()
+            slot = self.freeSlots.popleft()
+
+        self.ring.write(slot, pixels)
+        self.jobs[workerIndex].put(('frame', slot, frame.timestamp_unix_seconds, gaze, receivedAt))
+
+    def allocateRing(self, shape):
+        if self.ring is not None:
+            self.ring.close()
+
+        self.ring = FrameRing(self.processes, shape)
+        self.freeSlots = deque(range(self.processes))
+        for jobs in self.jobs:
+            jobs.put(('ring', self.ring.name, self.ring.slots, self.ring.shape))
+
+    def collect(self):
+        while True:
+            result = self.results.get()
+            if result is None:
+                break
+
+            workerIndex, slot, markerIds, points, timestamp, receivedAt, isOpen = result
+            with self.lock:
+                self.freeSlots.append(slot)
+                self.idleWorkers.append(workerIndex)
+                pending = self.pending
+                self.pending = None
+
+            if pending is not None:
+                self.submit(*pending)
+
+            if self.onResult is not None:
+                self.onResult(markerIds, points, timestamp, receivedAt, isOpen)
+
+    def close(self):
+        for jobs in self.jobs:
+            jobs.put(('stop',))
+        for worker in self.workers:
+            worker.join(timeout=1)
+
+        self.results.put(None)
+        if self.collector is not None:
+            self.collector.join()
+
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
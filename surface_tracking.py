@@ -0,0 +1,253 @@
+import time
+from collections import deque
+
+import cv2
+import numpy as np
+from pupil_apriltags import Detector
+
+from marker_pool import SurfaceSet, readMapperResult
+
+
+def markerCenters(markerVerts):
+    return {markerId: np.mean(verts, axis=0) for markerId, verts in markerVerts.items()}
+
+
+class AdaptiveDetector():
+    # Finds the surface tags on the grayscale scene image scaled down to the
+    # smallest of levels at which they are still found. When fewer than
+    # minMarkers of them turn up, the same frame is searched again at the next
+    # larger level and detection stays there; after stepDownAfter frames in a
+    # row with all tags found, the next smaller level is tried again.
+    #
+    # Per level it counts the frames searched, those with the tags found and
+    # the CPU time spent scaling and detecting.
+    def __init__(self, levels=(0.25, 0.5, 1.0), minMarkers=4, stepDownAfter=30):
+        self.levels = levels
+        self.minMarkers = minMarkers
+        self.stepDownAfter = stepDownAfter
+        # The image is already scaled; no further decimation inside apriltag
+        self.detector = Detector(families='tag36h11', quad_decimate=1.0)
+
+        self.level = 0
+        self.streak = 0
+        self.frames = [0] * len(levels)
+        self.found = [0] * len(levels)
+        self.cpuTime = [0.0] * len(levels)
+
+    def detect(self, gray, markerIds):
+        # Returns the detections of markerIds in full resolution image coordinates
+        level = self.level
+        while True:
+            detections = self.detectAt(gray, level, markerIds)
+            if len(detections) >= self.minMarkers or level == len(self.levels) - 1:
+                break
+            level += 1
+
+        if level != self.level:
+            self.level = level
+            self.streak = 0
+        elif len(detections) >= self.minMarkers:
+            self.streak += 1
+            if self.streak >= self.stepDownAfter and self.level > 0:
+                self.level -= 1
+                self.streak = 0
+
+        return detections
+
+    def detectAt(self, gray, level, markerIds):
+        start = time.thread_time()
+        scale = self.levels[level]
+        if scale != 1.0:
+            gray = cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+        detections = [detection for detection in self.detector.detect(gray) if detection.tag_id in markerIds]
+        for detection in detections:
+            detection.center = detection.center / scale
+            detection.corners = detection.corners / scale
+
+        self.frames[level] += 1
+        self.found[level] += len(detections) >= self.minMarkers
+        self.cpuTime[level] += time.thread_time() - start
+        return detections
+
+    def summary(self):
+        levels = [
+            f'{scale:g}x {self.found[level]/self.frames[level]*100:.0f}% found in {self.cpuTime[level]/self.frames[level]*1000:.1f} ms'
+            for level, scale in enumerate(self.levels) if self.frames[level]
+        ]
+        return ', '.join(levels)
+
+
+class SurfaceCache():
+    # Wraps a GazeMapper and skips its marker detection while the head is still.
+    #
+    # Every full detection also locates the four tags with our own detector and
+    # fits a homography from their (undistorted) scene image centers to the
+    # normalized surface. Until the next full detection, gaze is mapped through
+    # that homography. A full detection is forced every refreshInterval frames,
+    # when the scene image moved more than motionThreshold (mean absolute grey
+    # level change of a thumbnail) or, in ROI mode, when the tags can no longer
+    # be found near their last position.
+    #
+    # With adaptive, full detections skip the GazeMapper as well: the tags are
+    # found by an AdaptiveDetector on a downscaled image and gaze is always
+    # mapped through the homography. With mapperInterval > 1 only every
+    # mapperInterval-th full detection runs the GazeMapper, just to measure the
+    # cached mapping error; the others use our own detector alone.
+    def __init__(self, gazeMapper, calibration, refreshInterval=10, motionThreshold=4.0, searchRois=False, adaptive=False, mapperInterval=1):
+        self.gazeMapper = gazeMapper
+        self.surfaces = SurfaceSet(gazeMapper)
+        self.refreshInterval = refreshInterval
+        self.mapperInterval = mapperInterval
+        self.motionThreshold = motionThreshold
+        self.searchRois = searchRois
+
+        self.cameraMatrix = np.asarray(calibration['scene_camera_matrix'][0], dtype=np.float64)
+        self.distortion = np.asarray(calibration['scene_distortion_coefficients'][0], dtype=np.float64)
+        self.detector = Detector(families='tag36h11')
+        self.adaptiveDetector = AdaptiveDetector() if adaptive else None
+
+        self.surface = None
+        self.surfaceCenters = {}
+        self.homography = None
+        self.imageCenters = {}
+        self.markerSize = 0
+        self.markerIds = []
+        self.keyframeThumbnail = None
+        self.framesSinceDetection = 0
+
+        self.frames = 0
+        self.detections = 0
+        self.errors = deque(maxlen=1000)
+
+    def setSurface(self, markerVerts, surfaceSize, key):
+        self.surface = self.surfaces.activate(markerVerts, surfaceSize, key)
+
+        # Marker centers in the surface's normalized coordinates (origin bottom left)
+        width, height = surfaceSize
+        self.surfaceCenters = {
+            markerId: (center[0]/width, 1.0 - center[1]/height)
+            for markerId, center in markerCenters(markerVerts).items()
+        }
+        self.homography = None
+
+    def process_frame(self, frame, gaze):
+        # Returns (markerIds, points) like readMapperResult
+        self.frames += 1
+        gray = cv2.cvtColor(frame.bgr_pixels, cv2.COLOR_BGR2GRAY)
+        thumbnail = cv2.resize(gray, (80, 60), interpolation=cv2.INTER_AREA)
+
+        if self.canReuse(gray, thumbnail):
+            self.framesSinceDetection += 1
+            return self.markerIds, [self.mapGaze(gaze.x, gaze.y)]
+
+        return self.detect(frame, gaze, gray, thumbnail)
+
+    def canReuse(self, gray, thumbnail):
+        if self.homography is None or self.framesSinceDetection + 1 >= self.refreshInterval:
+            return False
+
+        motion = np.mean(cv2.absdiff(thumbnail, self.keyframeThumbnail))
+        if motion > self.motionThreshold:
+            return False
+
+        if self.searchRois:
+            if not self.trackRois(gray):
+                return False
+            self.keyframeThumbnail = thumbnail
+
+        return True
+
+    def detect(self, frame, gaze, gray, thumbnail):
+        self.detections += 1
+        if self.adaptiveDetector is not None:
+            return self.useDetections(gaze, self.adaptiveDetector.detect(gray, self.surfaceCenters), thumbnail)
+        if self.detections % self.mapperInterval:
+            return self.useDetections(gaze, self.detector.detect(gray), thumbnail)
+
+        result = self.gazeMapper.process_frame(frame, gaze)
+        markerIds, points = readMapperResult(result, self.surface)
+
+        # How far off the cached homography would have been on this frame
+        if self.homography is not None and points:
+            cached = self.mapGaze(gaze.x, gaze.y)
+            self.errors.append(np.hypot(cached[0] - points[0][0], cached[1] - points[0][1]))
+
+        self.markerIds = markerIds
+        self.keyframeThumbnail = thumbnail
+        self.framesSinceDetection = 0
+        self.fitHomography(self.detector.detect(gray))
+
+        return markerIds, points
+
+    def useDetections(self, gaze, detections, thumbnail):
+        self.markerIds = sorted(detection.tag_id for detection in detections)
+        self.keyframeThumbnail = thumbnail
+        self.framesSinceDetection = 0
+        if not self.fitHomography(detections):
+            return self.markerIds, []
+
+        return self.markerIds, [self.mapGaze(gaze.x, gaze.y)]
+
+    def trackRois(self, gray):
+        # Look for each tag only in a window around where it was last seen
+        margin = self.markerSize
+        height, width = gray.shape
+        detections = []
+
+        for center in self.imageCenters.values():
+            left = max(int(center[0] - margin), 0)
+            top = max(int(center[1] - margin), 0)
+            right = min(int(center[0] + margin), width)
+            bottom = min(int(center[1] + margin), height)
+
+            for detection in self.detector.detect(np.ascontiguousarray(gray[top:bottom, left:right])):
+                detection.center = detection.center + (left, top)
+                detection.corners = detection.corners + (left, top)
+                detections.append(detection)
+
+        return self.fitHomography(detections)
+
+    def fitHomography(self, detections):
+        found = {d.tag_id: d for d in detections if d.tag_id in self.surfaceCenters}
+        if len(found) < 4:
+            self.homography = None
+            return False
+
+        markerIds = sorted(found)
+        imagePoints = np.array([found[markerId].center for markerId in markerIds], dtype=np.float64)
+        surfacePoints = np.array([self.surfaceCenters[markerId] for markerId in markerIds], dtype=np.float64)
+
+        self.homography, _ = cv2.findHomography(self.undistort(imagePoints), surfacePoints)
+        self.imageCenters = {markerId: found[markerId].center for markerId in markerIds}
+        self.markerSize = max(np.ptp(found[markerId].corners[:, 0]) for markerId in markerIds)
+
+        return self.homography is not None
+
+    def undistort(self, points):
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 1, 2)
+        return cv2.undistortPoints(points, self.cameraMatrix, self.distortion, P=self.cameraMatrix)
+
+    def mapGaze(self, x, y):
+        # Safe to call from another thread than process_frame
+        homography = self.homography
+        if homography is None:
+            return None
+
+        mapped = cv2.perspectiveTransform(self.undistort([x, y]), homography)
+        return float(mapped[0, 0, 0]), float(mapped[0, 0, 1])
+
+    def skipRatio(self):
+        if self.frames == 0:
+            return 0.0
+        return 1.0 - self.detections/self.frames
+
+    def summary(self):
+        if self.errors:
+            errors = f'{np.mean(self.errors):.4f} mean, {np.percentile(self.errors, 95):.4f} p95'
+        else:
+            errors = 'n/a'
+        summary = f'detection skipped {self.skipRatio()*100:.0f}% of frames, cached mapping error {errors}'
+        if self.adaptiveDetector is not None:
+            summary += f'\nAdaptive detection: {self.adaptiveDetector.summary()}'
+        return summary